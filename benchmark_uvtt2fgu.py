@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+'''Time each stage of converting .dd2vtt files, on the example map and on synthetic maps of increasing size
+
+The results are written as a JSON report, and a report from an earlier
+version can be given with --compare to show how each stage has changed.
+'''
+
+import argparse
+import base64
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Optional
+
+import PIL
+from PIL import Image
+import uvtt2fgu
+
+baselinePath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+
+# Map size in grid squares, pixels per grid square and element counts
+syntheticCases = {
+    'small': {'size': (16, 16), 'gridsize': 100, 'walls': 100, 'objects': 20, 'portals': 20, 'lights': 20},
+    # About 100 MB
+    'medium': {'size': (40, 40), 'gridsize': 128, 'walls': 1000, 'objects': 200, 'portals': 200, 'lights': 100},
+    'large': {'size': (64, 64), 'gridsize': 128, 'walls': 5000, 'objects': 1000, 'portals': 1000, 'lights': 500},
+}
+
+startupCommands = {
+    'import': ['-c', 'import uvtt2fgu'],
+    'version': [str(Path(__file__).parent / 'uvtt2fgu.py'), '--version'],
+}
+
+stages = ['json_load', 'orjson_load', 'base64_decode', 'compose_occluders', 'write_xml', 'write_png', 'write_jpg',
+          'thumbnail_bands', 'thumbnail_full']
+
+
+def randomPolyline(rng: random.Random, size, points: int) -> list:
+    '''A wandering polyline of grid coordinates that stays on the map'''
+    x = rng.uniform(0, size[0])
+    y = rng.uniform(0, size[1])
+    line = []
+    for _ in range(points):
+        line.append({'x': round(x, 6), 'y': round(y, 6)})
+        x = min(max(x + rng.uniform(-1, 1), 0), size[0])
+        y = min(max(y + rng.uniform(-1, 1), 0), size[1])
+    return line
+
+
+def randomImage(width: int, height: int) -> bytes:
+    '''A noisy image, which compresses about as poorly as a detailed map'''
+    bands = [Image.effect_noise((width, height), sigma) for sigma in (20, 30, 40)]
+    image = Image.merge('RGB', bands)
+    out = BytesIO()
+    image.save(out, format='PNG', compress_level=1)
+    return out.getvalue()
+
+
+def generateMap(filepath: Path, size=(16, 16), gridsize: int = 100, walls: int = 100, objects: int = 20, portals: int = 20, lights: int = 20, seed: int = 0) -> None:
+    '''Write a synthetic .dd2vtt file with the given map size and number of each element'''
+    rng = random.Random(seed)
+    data = {
+        'format': 0.3,
+        'resolution': {
+            'map_origin': {'x': 0, 'y': 0},
+            'map_size': {'x': size[0], 'y': size[1]},
+            'pixels_per_grid': gridsize,
+        },
+        'line_of_sight': [randomPolyline(rng, size, rng.randint(2, 12)) for _ in range(walls)],
+        'objects_line_of_sight': [randomPolyline(rng, size, rng.randint(8, 40)) for _ in range(objects)],
+        'portals': [],
+        'environment': {'baked_lighting': False, 'ambient_light': 'ffffffff'},
+        'lights': [],
+    }
+
+    for _ in range(portals):
+        (x, y) = (rng.randint(1, size[0] - 1), rng.randint(1, size[1] - 1))
+        rotation = rng.choice([0, math.pi / 2])
+        (dx, dy) = (0.5, 0) if rotation == 0 else (0, 0.5)
+        data['portals'].append({
+            'position': {'x': x, 'y': y},
+            'bounds': [{'x': x - dx, 'y': y - dy}, {'x': x + dx, 'y': y + dy}],
+            'rotation': round(rotation, 6),
+            'closed': rng.random() < 0.8,
+            'freestanding': False,
+        })
+
+    for _ in range(lights):
+        data['lights'].append({
+            'position': {'x': round(rng.uniform(0, size[0]), 6), 'y': round(rng.uniform(0, size[1]), 6)},
+            'range': rng.choice([2, 5, 10]),
+            'intensity': 1,
+            'color': 'ff{:06x}'.format(rng.randrange(0x1000000)),
+            'shadows': True,
+        })
+
+    image = randomImage(size[0] * gridsize, size[1] * gridsize)
+    data['image'] = base64.b64encode(image).decode('ascii')
+    with filepath.open('w') as f:
+        json.dump(data, f)
+
+
+def timeStage(repeat: int, run: Callable[[], Optional[int]]) -> dict:
+    '''Time a stage, returning the fastest and mean times and the bytes it wrote'''
+    times = []
+    written = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        written = run()
+        times.append(time.perf_counter() - start)
+    result = {'min': min(times), 'mean': sum(times) / len(times)}
+    if written is not None:
+        result['bytes'] = written
+    return result
+
+
+def benchmarkFile(filepath: Path, outdir: Path, repeat: int) -> dict:
+    '''Time each stage of converting one file'''
+    results = {}
+
+    def load(backend):
+        def run():
+            uvtt2fgu.loadUVTTData(filepath, backend)
+        return run
+
+    results['json_load'] = timeStage(repeat, load('json'))
+    if uvtt2fgu.orjson:
+        results['orjson_load'] = timeStage(repeat, load('orjson'))
+
+    with filepath.open('r') as f:
+        encoded = json.load(f)['image'].encode('ascii')
+    results['base64_decode'] = timeStage(repeat, lambda encoded=encoded: len(base64.decodebytes(encoded)))
+    del encoded
+
+    options = uvtt2fgu.ConversionOptions()
+    uvttfile = uvtt2fgu.UVTTFile(filepath, options.portalWidth, options.portalLength, options=options)
+
+    def composeOccluders():
+        uvttfile.composeOccluders()
+    results['compose_occluders'] = timeStage(repeat, composeOccluders)
+
+    def writeFile(write, suffix):
+        def run():
+            # Each repeat decodes the image again, as a conversion would
+            uvttfile.decodedImages.clear()
+            outpath = outdir / (filepath.stem + suffix)
+            write(outpath)
+            return outpath.stat().st_size
+        return run
+
+    results['write_xml'] = timeStage(repeat, writeFile(uvttfile.writeXml, '.xml'))
+    results['write_png'] = timeStage(repeat, writeFile(uvttfile.writePng, '.png'))
+    results['write_jpg'] = timeStage(repeat, writeFile(uvttfile.writeJpg, '.jpg'))
+
+    def makeThumbnail(decode):
+        def run():
+            # Decoded a band at a time, or from a whole decode of the image
+            uvttfile.decodedImages.clear()
+            if decode:
+                uvttfile.decodeImage()
+            uvttfile.makeThumbnail((256, 256))
+        return run
+
+    results['thumbnail_bands'] = timeStage(repeat, makeThumbnail(False))
+    results['thumbnail_full'] = timeStage(repeat, makeThumbnail(True))
+
+    case = {
+        'file': filepath.name,
+        'bytes': filepath.stat().st_size,
+        'resolution': list(uvttfile.resolution),
+        'gridsize': uvttfile.gridsize,
+        'walls': len(uvttfile.data['line_of_sight']),
+        'objects': len(uvttfile.data.get('objects_line_of_sight', [])),
+        'portals': len(uvttfile.data['portals']),
+        'lights': len(uvttfile.data['lights']),
+        'stages': results,
+    }
+    uvttfile.close()
+    return case
+
+
+def benchmarkStartup(repeat: int) -> dict:
+    '''Time starting a new Python process to import uvtt2fgu, and to run uvtt2fgu.py --version'''
+    def start(command):
+        def run():
+            subprocess.run([sys.executable] + command, cwd=Path(__file__).parent, check=True, capture_output=True)
+        return run
+
+    return {name: timeStage(repeat, start(command)) for name, command in startupCommands.items()}
+
+
+def percentChange(result: dict, old: Optional[dict]) -> str:
+    '''The change in the fastest time from an earlier result'''
+    if not old or not old['min']:
+        return ''
+    return '{:+.1f}%'.format((result['min'] / old['min'] - 1) * 100)
+
+
+def printReport(report: dict, baseline: Optional[dict] = None) -> None:
+    '''Print the fastest time of each stage, and the change from a baseline report if given'''
+    baselineCases = {case['name']: case for case in (baseline or {}).get('cases', [])}
+    print('{:<10} {:<18} {:>10} {:>10}'.format('case', 'stage', 'seconds', 'change'))
+    for name, result in report['startup'].items():
+        old = (baseline or {}).get('startup', {}).get(name)
+        print('{:<10} {:<18} {:>10.4f} {:>10}'.format('startup', name, result['min'], percentChange(result, old)))
+    for case in report['cases']:
+        for stage in [stage for stage in stages if stage in case['stages']]:
+            result = case['stages'][stage]
+            old = baselineCases.get(case['name'], {}).get('stages', {}).get(stage)
+            print('{:<10} {:<18} {:>10.4f} {:>10}'.format(case['name'], stage, result['min'], percentChange(result, old)))
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    '''Set up the command-line argument parser'''
+    parser = argparse.ArgumentParser(
+        description='Time each stage of converting .dd2vtt files with uvtt2fgu'
+    )
+    parser.add_argument(
+        '--cases', nargs='*', choices=list(syntheticCases), default=['small', 'medium'],
+        help='Synthetic map sizes to benchmark, as well as the example map'
+    )
+    parser.add_argument(
+        '--compare', help='Earlier JSON report to compare against'
+    )
+    parser.add_argument(
+        '-o', '--output', default='benchmark.json', help='Path of the JSON report'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='Number of times to run each stage'
+    )
+    return parser
+
+
+def main() -> int:
+    args = init_argparse().parse_args()
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pillow': PIL.__version__,
+        'numpy': uvtt2fgu.np.__version__ if uvtt2fgu.np else None,
+        'repeat': args.repeat,
+        'startup': benchmarkStartup(max(args.repeat, 5)),
+        'cases': [],
+    }
+
+    # The large synthetic maps are bigger than Pillow allows by default
+    Image.MAX_IMAGE_PIXELS = None
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outdir = Path(tmpdir)
+        cases = [('baseline', baselinePath)]
+        for name in args.cases:
+            filepath = outdir / (name + '.dd2vtt')
+            print('Generating {} map'.format(name), file=sys.stderr)
+            generateMap(filepath, **syntheticCases[name])
+            cases.append((name, filepath))
+
+        for name, filepath in cases:
+            print('Benchmarking {}'.format(name), file=sys.stderr)
+            case = benchmarkFile(filepath, outdir, args.repeat)
+            case['name'] = name
+            report['cases'].append(case)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    printReport(report, baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
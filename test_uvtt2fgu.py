@@ -1,11 +1,49 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import base64
+import errno
+from io import BytesIO, StringIO
+import json
+import os
 from pathlib import Path
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+import zlib
 import uvtt2fgu
 
 
+class OutputTestCase(unittest.TestCase):
+    '''Converts into a temporary directory with the default configuration'''
+    samplePath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.outdir = Path(self.tmpdir.name)
+        uvtt2fgu.loadConfigData(None)
+        for attribute in ('xmlpath', 'pngpath', 'jpgpath'):
+            setattr(uvtt2fgu.configData, attribute, self.tmpdir.name)
+        uvtt2fgu.configData.remove = False
+        return super().setUp()
+
+    def copySample(self, name: str):
+        '''Copy the sample map into the output directory, returning its file paths'''
+        filepath = self.outdir / (name + '.dd2vtt')
+        shutil.copy(self.samplePath, filepath)
+        return uvtt2fgu.composeFilePaths(filepath)
+
 class TestComposeFilePaths(unittest.TestCase):
     def setUp(self) -> None:
         uvtt2fgu.loadConfigData(None)
@@ -78,5 +116,1055 @@ class TestPortalAdjust(unittest.TestCase):
         with self.assertRaises(argparse.ArgumentTypeError):
             args = parser.parse_args('--foo 99'.split())
 
+class TestLoadUVTTData(unittest.TestCase):
+    def setUp(self) -> None:
+        self.filepath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+        with self.filepath.open() as f:
+            self.expected = json.load(f)
+        return super().setUp()
+
+    @unittest.skipIf(not uvtt2fgu.orjson, 'orjson is not installed')
+    def test_orjson(self) -> None:
+        '''orjson gives exactly the same data, with the same types, from a file, bytes or a stream'''
+        for source in (self.filepath, self.filepath.read_bytes(), BytesIO(self.filepath.read_bytes())):
+            data = uvtt2fgu.loadUVTTData(source, 'orjson')
+            self.assertEqual(json.dumps(data), json.dumps(self.expected))
+
+    def test_fallback(self) -> None:
+        '''Without orjson the json module is used'''
+        with mock.patch.object(uvtt2fgu, 'orjson', uvtt2fgu.LazyModule('uvtt2fgu_missing_module', optional=True)):
+            self.assertEqual(uvtt2fgu.loadUVTTData(self.filepath), self.expected)
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(uvtt2fgu.loadUVTTData(self.filepath, 'orjson'), self.expected)
+
+    def test_unknown(self) -> None:
+        with self.assertRaises(ValueError):
+            uvtt2fgu.loadUVTTData(self.filepath, 'simdjson')
+
+class TestUVTTStreamReader(unittest.TestCase):
+    samplePath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+
+    def test_samplemap(self) -> None:
+        '''The streamed sections and image match a full json load'''
+        with self.samplePath.open() as f:
+            expected = json.load(f)
+        image = BytesIO()
+        with self.samplePath.open() as f:
+            data = uvtt2fgu.UVTTStreamReader(f).read(image)
+        self.assertEqual(image.getvalue(), base64.b64decode(expected.pop('image')))
+        self.assertEqual(data, expected)
+
+    def test_smallchunks(self) -> None:
+        '''Values and escapes split across reads are reassembled'''
+        imagebytes = bytes(range(256)) * 3
+        encoded = base64.encodebytes(imagebytes).decode('ascii').replace('/', '\\/').replace('\n', '\\n')
+        text = '{"format": 0.3, "image": "' + encoded + '", "lights": [{"range": 12345}]}'
+        image = BytesIO()
+        data = uvtt2fgu.UVTTStreamReader(StringIO(text), chunkSize=3).read(image)
+        self.assertEqual(image.getvalue(), imagebytes)
+        self.assertEqual(data, {'format': 0.3, 'lights': [{'range': 12345}]})
+
+    def test_skipimage(self) -> None:
+        '''Without a sink the image is skipped'''
+        text = '{"image": "not base64 at all", "portals": []}'
+        data = uvtt2fgu.UVTTStreamReader(StringIO(text)).read()
+        self.assertEqual(data, {'portals': []})
+
+    def test_header(self) -> None:
+        '''Only the start of the image is decoded, and reading stops once the resolution is known'''
+        imagebytes = bytes(range(256))
+        encoded = base64.b64encode(imagebytes).decode('ascii')
+        resolution = {'pixels_per_grid': 128}
+        text = '{"resolution": ' + json.dumps(resolution) + ', "image": "' + encoded + '", "lights": [}'
+        (data, header) = uvtt2fgu.UVTTStreamReader(StringIO(text), chunkSize=5).readHeader(10)
+        self.assertEqual(data, {'resolution': resolution})
+        self.assertEqual(header[:10], imagebytes[:10])
+
+        text = '{"image": "' + encoded + '", "resolution": ' + json.dumps(resolution) + '}'
+        (data, header) = uvtt2fgu.UVTTStreamReader(StringIO(text), chunkSize=5).readHeader(10)
+        self.assertEqual(data, {'resolution': resolution})
+        self.assertEqual(header[:10], imagebytes[:10])
+
+    def test_truncated(self) -> None:
+        '''A partially written file is an error'''
+        with self.assertRaises(ValueError):
+            uvtt2fgu.UVTTStreamReader(StringIO('{"format": 0.3, "image": "iVBO')).read(BytesIO())
+
+class TestCopyImageFile(unittest.TestCase):
+    data = bytes(range(256)) * 1000
+
+    def copyFromTempFile(self) -> bytes:
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(self.data)
+            uvtt2fgu.copyImageFile(src, dst)
+            dst.seek(0)
+            return dst.read()
+
+    def test_bytesio(self) -> None:
+        '''An in-memory image is written directly'''
+        dst = BytesIO()
+        uvtt2fgu.copyImageFile(BytesIO(self.data), dst)
+        self.assertEqual(dst.getvalue(), self.data)
+
+    def test_file(self) -> None:
+        '''An image in a file is copied by the kernel'''
+        self.assertEqual(self.copyFromTempFile(), self.data)
+
+    def test_mmapfallback(self) -> None:
+        '''Without kernel copy support the file is written from a memory map'''
+        with mock.patch.object(uvtt2fgu.os, 'copy_file_range', side_effect=OSError, create=True), \
+                mock.patch.object(uvtt2fgu.os, 'sendfile', side_effect=OSError, create=True):
+            self.assertEqual(self.copyFromTempFile(), self.data)
+
+class TestDecodeImage(unittest.TestCase):
+    samplePath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+
+    def setUp(self) -> None:
+        uvtt2fgu.loadConfigData(None)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = Path(self.tmpdir.name)
+        self.uvttfile = uvtt2fgu.UVTTFile(self.samplePath, '25%', '0px')
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.uvttfile.close()
+        self.tmpdir.cleanup()
+        return super().tearDown()
+
+    def test_pngonly(self) -> None:
+        '''Writing the .png passes the image through without decoding it'''
+        with mock.patch.object(uvtt2fgu.Image, 'open', wraps=uvtt2fgu.Image.open) as imageOpen:
+            self.uvttfile.writePng(self.outdir / 'map.png')
+        imageOpen.assert_not_called()
+
+    def test_decodeonce(self) -> None:
+        '''Every encoder shares a single decode of the image'''
+        with mock.patch.object(uvtt2fgu.Image, 'open', wraps=uvtt2fgu.Image.open) as imageOpen:
+            self.uvttfile.writeJpg(self.outdir / 'map1.jpg')
+            self.uvttfile.writeJpg(self.outdir / 'map2.jpg')
+            self.assertIs(self.uvttfile.decodeImage('RGB'), self.uvttfile.decodeImage('RGB'))
+        imageOpen.assert_called_once()
+
+    def test_corrupt(self) -> None:
+        '''A corrupt image does not leave empty .jpg files behind'''
+        uvtt2fgu.configData.thumbnailSize = (64, 64)
+        self.uvttfile.imageFile = BytesIO(b'\x89PNG\r\n\x1a\n' + bytes(100))
+        for write in (self.uvttfile.writeJpg, self.uvttfile.writeThumbnail):
+            with self.assertRaises(Exception):
+                write(self.outdir / 'map.jpg')
+            self.assertFalse((self.outdir / 'map.jpg').exists())
+
+class TestConversionCache(OutputTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        uvtt2fgu.configData.writejpg = False
+        self.filepaths = self.copySample('map')
+        self.uvttpath = self.filepaths[0]
+        self.settings = uvtt2fgu.conversionSettings('25%', '0px')
+        cache = uvtt2fgu.ConversionCache(self.outdir, self.settings)
+        uvtt2fgu.processFiles([self.filepaths], '25%', '0px', cache)
+        cache.save()
+
+    def test_hit(self) -> None:
+        '''An unchanged input with unchanged outputs is up to date'''
+        cache = uvtt2fgu.ConversionCache(self.outdir, self.settings)
+        self.assertTrue(cache.isUpToDate(self.filepaths))
+        self.assertEqual((cache.hits, cache.converted), (1, 0))
+
+    def test_touched(self) -> None:
+        '''An input with a new modification time but the same contents is up to date'''
+        stat = self.uvttpath.stat()
+        os.utime(self.uvttpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        cache = uvtt2fgu.ConversionCache(self.outdir, self.settings)
+        self.assertTrue(cache.isUpToDate(self.filepaths))
+
+    def test_changedsettings(self) -> None:
+        '''Different conversion settings need a new conversion'''
+        cache = uvtt2fgu.ConversionCache(self.outdir, uvtt2fgu.conversionSettings('50%', '0px'))
+        self.assertFalse(cache.isUpToDate(self.filepaths))
+        self.assertEqual((cache.hits, cache.converted), (0, 0))
+
+    def test_changedgeometry(self) -> None:
+        '''Different portal settings only rewrite the .xml'''
+        pngstat = self.filepaths[1].stat()
+        xmlbefore = self.filepaths[3].read_text()
+        cache = uvtt2fgu.ConversionCache(self.outdir, uvtt2fgu.conversionSettings('50%', '0px'))
+        self.assertFalse(cache.isUpToDate(self.filepaths))
+        self.assertTrue(cache.imagesUpToDate(self.filepaths))
+        with mock.patch.object(uvtt2fgu.UVTTStreamReader, 'readImage', autospec=True,
+                               side_effect=uvtt2fgu.UVTTStreamReader.readImage) as readImage:
+            uvtt2fgu.processFiles([self.filepaths], '50%', '0px', cache)
+        self.assertIsNone(readImage.call_args.args[1])
+        self.assertEqual(self.filepaths[1].stat().st_mtime_ns, pngstat.st_mtime_ns)
+        self.assertNotEqual(self.filepaths[3].read_text(), xmlbefore)
+        self.assertTrue(cache.isUpToDate(self.filepaths))
+        self.assertEqual(cache.converted, 1)
+
+    def test_failed(self) -> None:
+        '''A failed conversion is forgotten rather than counted as converted'''
+        cache = uvtt2fgu.ConversionCache(self.outdir, self.settings)
+        cache.update(self.filepaths, errno.EIO)
+        self.assertEqual(cache.converted, 0)
+        self.assertFalse(cache.isUpToDate(self.filepaths))
+
+    def test_changedimagesettings(self) -> None:
+        '''Different image settings need the images written again'''
+        uvtt2fgu.configData.jpgQuality = 50
+        cache = uvtt2fgu.ConversionCache(self.outdir, uvtt2fgu.conversionSettings('25%', '0px'))
+        self.assertFalse(cache.isUpToDate(self.filepaths))
+        self.assertFalse(cache.imagesUpToDate(self.filepaths))
+
+    def test_changedoutput(self) -> None:
+        '''A modified output needs a new conversion'''
+        with self.filepaths[3].open('a') as f:
+            f.write(' ')
+        cache = uvtt2fgu.ConversionCache(self.outdir, self.settings)
+        self.assertFalse(cache.isUpToDate(self.filepaths))
+
+class TestXmlStreamWriter(unittest.TestCase):
+    def test_samplemap(self) -> None:
+        '''The streamed .xml is identical to minidom's pretty printing of the whole document'''
+        uvtt2fgu.loadConfigData(None)
+        uvttfile = uvtt2fgu.UVTTFile(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt',
+                                     '25%', '0px', loadImage=False)
+        expected = minidom.parseString(ET.tostring(uvttfile.composeXml())).toprettyxml(indent='  ')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xmlpath = Path(tmpdir) / 'map.xml'
+            uvttfile.writeXml(xmlpath)
+            self.assertEqual(xmlpath.read_text(), expected)
+
+    def test_elements(self) -> None:
+        '''Empty, text and nested elements are formatted like minidom'''
+        root = ET.Element('root', attrib={'a': '1 & "2"'})
+        ET.SubElement(root, 'empty')
+        ET.SubElement(root, 'text').text = '<3>'
+        nested = ET.SubElement(root, 'nested')
+        ET.SubElement(nested, 'child')
+        ET.SubElement(root, 'nochildren')
+        out = StringIO()
+        writer = uvtt2fgu.XmlStreamWriter(out)
+        writer.start(root.tag, root.attrib)
+        for child in root:
+            writer.element(child)
+        writer.start('streamed')
+        writer.end()
+        writer.end()
+        ET.SubElement(root, 'streamed')
+        self.assertEqual(out.getvalue(), minidom.parseString(ET.tostring(root)).toprettyxml(indent='  '))
+
+class TestTranslatePolyline(unittest.TestCase):
+    def setUp(self) -> None:
+        uvtt2fgu.loadConfigData(None)
+        self.uvttfile = uvtt2fgu.UVTTFile(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt',
+                                          '25%', '0px', loadImage=False)
+        rng = random.Random(1234)
+        self.coords = [{'x': rng.choice([rng.randint(-50, 50), round(rng.uniform(-50, 50), rng.randint(0, 6))]),
+                        'y': rng.choice([rng.randint(-50, 50), round(rng.uniform(-50, 50), rng.randint(0, 6))])}
+                       for i in range(5000)]
+        # Values that land on or next to a rounding tie
+        self.coords.extend({'x': i / 5120, 'y': -i / 10240} for i in range(1000))
+        return super().setUp()
+
+    def scalar(self, coords) -> list:
+        with mock.patch.object(uvtt2fgu, 'np', None):
+            return self.uvttfile.translatePolyline(coords)
+
+    @unittest.skipIf(not uvtt2fgu.np, 'NumPy is not installed')
+    def test_matchesscalar(self) -> None:
+        '''The vectorized translation formats exactly like the scalar translation'''
+        self.assertEqual(list(map(repr, self.uvttfile.translatePolyline(self.coords))),
+                         list(map(repr, self.scalar(self.coords))))
+
+    @unittest.skipIf(not uvtt2fgu.np, 'NumPy is not installed')
+    def test_allints(self) -> None:
+        '''Whole grid coordinates are formatted without a decimal point'''
+        coords = [{'x': i, 'y': -i} for i in range(100)]
+        self.assertEqual(list(map(repr, self.uvttfile.translatePolyline(coords))),
+                         list(map(repr, self.scalar(coords))))
+
+    def test_scalar(self) -> None:
+        '''Without NumPy the points are translated one at a time'''
+        point = self.uvttfile.translatePoint(self.coords[0])
+        self.assertEqual(self.scalar(self.coords[:1]), [point.x, point.y])
+
+class TestOccluder(unittest.TestCase):
+    def test_mixedcoords(self) -> None:
+        '''Int coordinates are written without a decimal point, floats with one'''
+        wall = uvtt2fgu.UVTTFile.WallOccluder()
+        wall.addCoords([0, 1024, 0, 896.0])
+        wall.addPoint(uvtt2fgu.Point(-0.04, 12.25))
+        self.assertEqual(wall.xmlPointsElem().text, '0,1024,0,896.0,-0.0,12.2')
+
+    def test_allints(self) -> None:
+        wall = uvtt2fgu.UVTTFile.WallOccluder()
+        wall.addCoords([1, -2, 3, -4])
+        self.assertEqual(wall.xmlPointsElem().text, '1,-2,3,-4')
+
+    def test_pointslots(self) -> None:
+        '''Points do not carry an instance dict'''
+        with self.assertRaises(AttributeError):
+            uvtt2fgu.Point(1, 2).z = 3
+
+class TestSimplifyPolyline(unittest.TestCase):
+    def test_collinear(self) -> None:
+        '''Points along a straight line are removed'''
+        coords = [0, 0, 10, 0.5, 20, 0, 30, -0.5, 40, 0]
+        self.assertEqual(uvtt2fgu.simplifyPolyline(coords, 1, set()), [0, 0, 40, 0])
+
+    def test_corner(self) -> None:
+        '''Points further than the tolerance are kept'''
+        coords = [0, 0, 10, 0.5, 20, 0, 20, 10, 20, 20]
+        self.assertEqual(uvtt2fgu.simplifyPolyline(coords, 1, set()), [0, 0, 20, 0, 20, 20])
+
+    def test_pinned(self) -> None:
+        '''Points that a portal attaches to are never removed'''
+        coords = [0, 0, 10, 0.5, 20, 0, 30, -0.5, 40, 0]
+        self.assertEqual(uvtt2fgu.simplifyPolyline(coords, 1, {(20, 0)}), [0, 0, 20, 0, 40, 0])
+
+    def test_closedloop(self) -> None:
+        '''A closed loop keeps its shape'''
+        coords = [0, 0, 10, 0, 10, 10, 0, 10, 0, 0]
+        self.assertEqual(uvtt2fgu.simplifyPolyline(coords, 1, set()), coords)
+
+    def test_tolerance(self) -> None:
+        '''Tolerances are a percentage of the grid or a number of pixels'''
+        self.assertEqual(uvtt2fgu.translateTolerance(256, '10%'), 25.6)
+        self.assertEqual(uvtt2fgu.translateTolerance(256, '3px'), 3)
+
+class TestMergeWalls(unittest.TestCase):
+    def test_room(self) -> None:
+        '''Four walls sharing corners become one closed loop'''
+        walls = [[0, 0, 10, 0], [10, 0, 10, 10], [0, 10, 10, 10], [0, 10, 0, 0]]
+        merged = uvtt2fgu.mergeWalls(walls)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(len(merged[0]), 10)
+        self.assertEqual(merged[0][:2], merged[0][-2:])
+
+    def test_collinear(self) -> None:
+        '''Collinear runs collapse to a single segment'''
+        walls = [[0, 0, 5, 0, 10, 0], [10, 0, 20.5, 0]]
+        self.assertEqual(uvtt2fgu.mergeWalls(walls), [[0, 0, 20.5, 0]])
+
+    def test_overlapping(self) -> None:
+        '''Duplicate and overlapping segments are removed'''
+        walls = [[0, 0, 0, 10], [0, 10, 0, 0], [0, 5, 0, 15.5]]
+        self.assertEqual(uvtt2fgu.mergeWalls(walls), [[0, 0, 0, 15.5]])
+
+    def test_separate(self) -> None:
+        '''Walls that do not touch are left alone'''
+        walls = [[0, 0, 0, 10], [0, 11, 0, 20], [5, 5, 7, 9.5]]
+        self.assertEqual(uvtt2fgu.mergeWalls(walls), walls)
+
+    def test_branch(self) -> None:
+        '''Walls carry on through a point where three of them meet'''
+        walls = [[0, 0, 10, 0], [10, 0, 20, 5], [10, 0, 10, 10]]
+        self.assertEqual(len(uvtt2fgu.mergeWalls(walls)), 2)
+
+    def test_junction_polyline(self) -> None:
+        '''A wall is not broken apart where another wall branches off it'''
+        walls = [[0, 0, 10, 0, 10, 10], [10, 0, 20, 0.5]]
+        self.assertEqual(len(uvtt2fgu.mergeWalls(walls)), 2)
+
+    def test_crossing_loops(self) -> None:
+        '''Two rooms touching at a corner become a single closed polyline'''
+        walls = [[0, 0, 10, 0, 10, 10, 0, 10, 0, 0], [10, 10, 20, 10, 20, 20, 10, 20, 10, 10]]
+        merged = uvtt2fgu.mergeWalls(walls)
+        self.assertEqual(len(merged), 1)
+        # The walls through the shared corner are collinear, so each pair is one segment
+        self.assertEqual(len(merged[0]), 14)
+        self.assertEqual(merged[0][:2], merged[0][-2:])
+
+    def test_random(self) -> None:
+        '''Walls along a grid cover the same edges, in no more polylines than before'''
+        def edges(polylines):
+            result = set()
+            for coords in polylines:
+                points = list(zip(coords[0::2], coords[1::2]))
+                for ((x1, y1), (x2, y2)) in zip(points, points[1:]):
+                    steps = max(abs(x2 - x1), abs(y2 - y1)) // 10
+                    (dx, dy) = ((x2 - x1) // steps, (y2 - y1) // steps)
+                    for step in range(steps):
+                        (x, y) = (x1 + step * dx, y1 + step * dy)
+                        result.add(frozenset([(x, y), (x + dx, y + dy)]))
+            return result
+
+        rng = random.Random(1)
+        walls = []
+        for _ in range(200):
+            (x, y) = (rng.randrange(10), rng.randrange(10))
+            coords = [x * 10, y * 10]
+            for _ in range(rng.randint(1, 5)):
+                (dx, dy) = rng.choice([(0, 1), (1, 0), (0, -1), (-1, 0)])
+                (x, y) = (x + dx, y + dy)
+                coords += [x * 10, y * 10]
+            walls.append(coords)
+        merged = uvtt2fgu.mergeWalls(walls)
+        self.assertLessEqual(len(merged), len(walls))
+        self.assertEqual(edges(merged), edges(walls))
+
+class TestPngBandReader(unittest.TestCase):
+    def assertBandsMatch(self, pngbytes: bytes, rows: int) -> None:
+        expected = uvtt2fgu.Image.open(BytesIO(pngbytes))
+        expected.load()
+        reader = uvtt2fgu.PngBandReader(BytesIO(pngbytes))
+        self.assertTrue(reader.supported)
+        bands = list(reader.bands(rows))
+        self.assertEqual([top for (top, band) in bands], list(range(0, expected.height, rows)))
+        self.assertEqual(b''.join(band.tobytes() for (top, band) in bands), expected.tobytes())
+
+    def test_samplemap(self) -> None:
+        '''Bands of the sample map decode to the same pixels as the whole image'''
+        with (Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt').open() as f:
+            pngbytes = base64.b64decode(json.load(f)['image'])
+        self.assertBandsMatch(pngbytes, 700)
+
+    def test_palette(self) -> None:
+        '''Palette images keep their palette in every band'''
+        image = uvtt2fgu.Image.effect_noise((97, 61), 64).convert('P')
+        out = BytesIO()
+        image.save(out, format='PNG')
+        self.assertBandsMatch(out.getvalue(), 8)
+
+    def test_wide(self) -> None:
+        '''Rows longer than a stored deflate block still decode'''
+        image = uvtt2fgu.Image.effect_noise((20000, 5), 64).convert('RGBA')
+        out = BytesIO()
+        image.save(out, format='PNG')
+        self.assertBandsMatch(out.getvalue(), 2)
+
+    def test_stored_zlib(self) -> None:
+        '''The uncompressed zlib stream holds the blocks as they are'''
+        blocks = [bytes(range(256)) * 300, b'', b'abc']
+        self.assertEqual(zlib.decompress(uvtt2fgu.PngBandReader.storedZlib(blocks)), b''.join(blocks))
+
+    def test_truncated(self) -> None:
+        '''A PNG cut off part way through a chunk is reported as a bad image'''
+        out = BytesIO()
+        uvtt2fgu.Image.new('RGB', (16, 16)).save(out, format='PNG')
+        for length in (12, 20, 40):
+            with self.assertRaisesRegex(ValueError, 'Truncated'):
+                uvtt2fgu.PngBandReader(BytesIO(out.getvalue()[:length]))
+
+    def test_unsupported(self) -> None:
+        '''Images with 16 bits per channel are flagged as unsupported'''
+        out = BytesIO()
+        uvtt2fgu.Image.new('I;16', (16, 16)).save(out, format='PNG')
+        self.assertFalse(uvtt2fgu.PngBandReader(BytesIO(out.getvalue())).supported)
+
+class TestWriteTiles(unittest.TestCase):
+    def test_pyramid(self) -> None:
+        '''Each level has half as many pixels across as the one before'''
+        uvtt2fgu.loadConfigData(None)
+        uvttfile = uvtt2fgu.UVTTFile(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', '25%', '0px')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tilepath = Path(tmpdir)
+            uvttfile.writeTiles(tilepath, 1024, 1)
+            with (tilepath / 'tiles.json').open() as f:
+                manifest = json.load(f)
+            self.assertEqual((manifest['width'], manifest['height']), (2560, 2560))
+            self.assertEqual([(level['columns'], level['rows']) for level in manifest['levels']], [(3, 3), (2, 2)])
+            self.assertEqual(uvtt2fgu.Image.open(tilepath / '0' / '2_2.jpg').size, (512, 512))
+            self.assertEqual(uvtt2fgu.Image.open(tilepath / '1' / '1_0.jpg').size, (1024, 256))
+        uvttfile.close()
+
+    def test_before_jpg(self) -> None:
+        '''The tiles are decoded in bands even when the .jpg decodes the whole image'''
+        uvtt2fgu.loadConfigData(None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for attribute in ('xmlpath', 'pngpath', 'jpgpath'):
+                setattr(uvtt2fgu.configData, attribute, tmpdir)
+            uvtt2fgu.configData.remove = False
+            uvtt2fgu.configData.tileSize = 1024
+            uvttpath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+            with mock.patch.object(uvtt2fgu.PngBandReader, 'bands', autospec=True,
+                                   side_effect=uvtt2fgu.PngBandReader.bands) as bands:
+                uvtt2fgu.processFile(uvtt2fgu.composeFilePaths(uvttpath), '25%', '0px')
+            bands.assert_called_once()
+            self.assertTrue((Path(tmpdir) / 'sampleMap.jpg').exists())
+            self.assertTrue((Path(tmpdir) / 'sampleMap_tiles' / 'tiles.json').exists())
+
+class TestThumbnail(unittest.TestCase):
+    def setUp(self) -> None:
+        self.filepath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+        return super().setUp()
+
+    def test_parse_size(self) -> None:
+        self.assertEqual(uvtt2fgu.parseImageSize('256X128'), (256, 128))
+        for size in ['256', '0x256', 'axb']:
+            with self.assertRaises(ValueError):
+                uvtt2fgu.parseImageSize(size)
+
+    def test_bands_match_full_decode(self) -> None:
+        '''A thumbnail reduced band by band looks like one reduced from the whole image'''
+        options = uvtt2fgu.ConversionOptions()
+        uvttfile = uvtt2fgu.UVTTFile(self.filepath, '25%', '0px', options=options)
+        banded = uvttfile.makeThumbnail((300, 200))
+        self.assertNotIn(None, uvttfile.decodedImages)
+        uvttfile.decodeImage('RGB')
+        full = uvttfile.makeThumbnail((300, 200))
+        uvttfile.close()
+        self.assertEqual(banded.size, (200, 200))
+        self.assertEqual(full.size, banded.size)
+        difference = [abs(a - b) for (a, b) in zip(full.tobytes(), banded.tobytes())]
+        self.assertLess(max(difference), 8)
+
+    def test_reuses_full_decode(self) -> None:
+        '''Writing the .jpg and the thumbnail decodes the image once'''
+        options = uvtt2fgu.ConversionOptions(writepng=False, thumbnailSize=(64, 64))
+        with mock.patch.object(uvtt2fgu.UVTTFile, 'iterImageBands') as iterImageBands:
+            result = uvtt2fgu.convert(self.filepath.read_bytes(), options)
+        iterImageBands.assert_not_called()
+        self.assertEqual(uvtt2fgu.Image.open(BytesIO(result.thumbnail)).size, (64, 64))
+
+class TestEncodeJpgToSize(unittest.TestCase):
+    def setUp(self) -> None:
+        uvtt2fgu.loadConfigData(None)
+        self.uvttfile = uvtt2fgu.UVTTFile(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', '25%', '0px')
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.uvttfile.close()
+        return super().tearDown()
+
+    def test_fits(self) -> None:
+        '''The configured quality is used when it already fits'''
+        (quality, data, attempts) = self.uvttfile.encodeJpgToSize(10 * 1024 * 1024)
+        self.assertEqual((quality, attempts), (75, 1))
+
+    def test_search(self) -> None:
+        '''The highest quality that fits is found with a binary search'''
+        (quality, data, attempts) = self.uvttfile.encodeJpgToSize(300 * 1024)
+        self.assertLess(quality, 75)
+        self.assertLessEqual(len(data), 300 * 1024)
+        self.assertLessEqual(attempts, 8)
+        (_, larger, _) = self.uvttfile.encodeJpgToSize(len(data) - 1)
+        self.assertLess(len(larger), len(data))
+
+    def test_toosmall(self) -> None:
+        '''The lowest quality is used when nothing fits'''
+        with self.assertLogs(level='WARNING'):
+            (quality, data, attempts) = self.uvttfile.encodeJpgToSize(100)
+        self.assertEqual(quality, 1)
+
+    def test_bytesize(self) -> None:
+        self.assertEqual(uvtt2fgu.parseByteSize('800K'), 800 * 1024)
+        self.assertEqual(uvtt2fgu.parseByteSize('1.5m'), 1572864)
+        self.assertEqual(uvtt2fgu.parseByteSize('1234'), 1234)
+
+class TestImageEncoders(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = Path(self.tmpdir.name)
+        configpath = self.outdir / 'uvtt2fgu.conf'
+        configpath.write_text('[default]\nwritewebp=True\nwebpquality=50\nwebppath={}\n'.format(self.outdir))
+        uvtt2fgu.loadConfigData(str(configpath))
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+        return super().tearDown()
+
+    def test_config(self) -> None:
+        '''Encoders are turned on and set up from the configuration file'''
+        (encoder,) = uvtt2fgu.configData.encoders
+        self.assertEqual(encoder.name, 'webp')
+        self.assertEqual(encoder.settings(), {'quality': 50, 'method': 4})
+        self.assertEqual(uvtt2fgu.composeEncoderPath(encoder, Path('abc/map.dd2vtt')), self.outdir / 'map.webp')
+
+    def test_enable(self) -> None:
+        '''Encoders turned on from the command line share the configuration file settings'''
+        uvtt2fgu.configData.enableEncoder('webp')
+        uvtt2fgu.configData.enableEncoder('optpng')
+        self.assertEqual([encoder.name for encoder in uvtt2fgu.configData.encoders], ['webp', 'optpng'])
+
+    def test_lossless(self) -> None:
+        '''Lossless WebP has its own settings and keeps every pixel'''
+        configpath = self.outdir / 'uvtt2fgu.conf'
+        configpath.write_text('[default]\nwritewebplossless=True\nwebplosslessquality=20\nwebplosslesspath={}\n'.format(self.outdir))
+        uvtt2fgu.loadConfigData(str(configpath))
+        (encoder,) = uvtt2fgu.configData.encoders
+        self.assertEqual(encoder.settings(), {'quality': 20, 'method': 4})
+        image = uvtt2fgu.Image.new('RGB', (16, 16), (10, 200, 30))
+        encoder.save(image, self.outdir / 'map.webp')
+        with uvtt2fgu.Image.open(self.outdir / 'map.webp') as saved:
+            self.assertEqual(saved.convert('RGB').tobytes(), image.tobytes())
+
+    def test_shareddecode(self) -> None:
+        '''The .jpg and the additional formats share one decode of the image'''
+        uvtt2fgu.configData.xmlpath = self.tmpdir.name
+        uvtt2fgu.configData.pngpath = self.tmpdir.name
+        uvtt2fgu.configData.jpgpath = self.tmpdir.name
+        uvttpath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+        with mock.patch.object(uvtt2fgu.Image, 'open', wraps=uvtt2fgu.Image.open) as imageOpen:
+            uvtt2fgu.processFile(uvtt2fgu.composeFilePaths(uvttpath), '25%', '0px')
+        imageOpen.assert_called_once()
+        self.assertEqual(uvtt2fgu.Image.open(self.outdir / 'sampleMap.webp').format, 'WEBP')
+
+class TestProcessFiles(OutputTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        uvtt2fgu.configData.writejpg = False
+
+    def composeJobs(self):
+        '''One valid map and one corrupt map'''
+        badpath = self.outdir / 'bad.dd2vtt'
+        badpath.write_text('{"resolution": ')
+        return [uvtt2fgu.composeFilePaths(badpath), self.copySample('good')]
+
+    def test_serial(self) -> None:
+        '''A bad file does not stop the rest of the batch'''
+        uvtt2fgu.configData.jobs = 1
+        exitcode = uvtt2fgu.processFiles(self.composeJobs(), '25%', '0px')
+        self.assertEqual(exitcode, errno.EIO)
+        self.assertTrue((self.outdir / 'good.xml').exists())
+        self.assertTrue((self.outdir / 'good.png').exists())
+
+    def test_parallel(self) -> None:
+        '''The log output is reported in file order when run in parallel'''
+        uvtt2fgu.configData.jobs = 2
+        with self.assertLogs(level='INFO') as logs:
+            exitcode = uvtt2fgu.processFiles(self.composeJobs(), '25%', '0px')
+        self.assertEqual(exitcode, errno.EIO)
+        self.assertTrue((self.outdir / 'good.xml').exists())
+        self.assertIn('bad.dd2vtt', logs.output[0])
+        self.assertIn('bad.dd2vtt', logs.output[1])
+        self.assertIn('good.dd2vtt', logs.output[2])
+
+    def test_memory_budget(self) -> None:
+        '''Files too big for the memory budget are still converted, and reported in file order'''
+        uvtt2fgu.configData.jobs = 2
+        uvtt2fgu.configData.maxMemory = 1
+        with self.assertLogs(level='INFO') as logs:
+            exitcode = uvtt2fgu.processFiles(self.composeJobs(), '25%', '0px')
+        self.assertEqual(exitcode, errno.EIO)
+        self.assertTrue((self.outdir / 'good.xml').exists())
+        self.assertIn('more than --max-memory', logs.output[0])
+        self.assertIn('bad.dd2vtt', logs.output[1])
+        self.assertIn('bad.dd2vtt', logs.output[2])
+        self.assertIn('good.dd2vtt', logs.output[3])
+
+class TestMain(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.outdir = Path(self.tmpdir.name)
+        self.config = self.outdir / 'uvtt2fgu.conf'
+        self.config.write_text('[default]\nwritejpg = False\n')
+        return super().setUp()
+
+    def main(self, *args: str) -> int:
+        argv = ['uvtt2fgu.py', '-c', str(self.config), '-o', str(self.outdir)] + list(args)
+        with mock.patch.object(sys, 'argv', argv):
+            return uvtt2fgu.main()
+
+    def test_skipped_files(self) -> None:
+        '''Missing inputs and existing outputs only skip their own file'''
+        for name in ('a', 'b'):
+            shutil.copy(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', self.outdir / (name + '.dd2vtt'))
+        (self.outdir / 'a.xml').touch()
+        with self.assertLogs(level='ERROR'):
+            exitcode = self.main(str(self.outdir / 'missing.dd2vtt'), str(self.outdir / 'a.dd2vtt'),
+                                 str(self.outdir / 'b.dd2vtt'))
+        self.assertEqual(exitcode, errno.EEXIST)
+        self.assertEqual((self.outdir / 'a.xml').stat().st_size, 0)
+        self.assertTrue((self.outdir / 'b.xml').exists())
+
+    def test_cache_summary(self) -> None:
+        '''A file skipped because its outputs exist is not counted as converted'''
+        uvttpath = self.outdir / 'a.dd2vtt'
+        shutil.copy(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', uvttpath)
+        with self.assertLogs(level='INFO'):
+            self.assertEqual(self.main('--cache', str(uvttpath)), 0)
+        with self.assertLogs(level='INFO') as logs:
+            self.assertEqual(self.main('--cache', '--portalwidth', '50%', str(uvttpath)), errno.EEXIST)
+        self.assertIn('INFO:root:Cache: 0 up to date, 0 converted', logs.output)
+
+class TestMemoryScheduler(unittest.TestCase):
+    def test_budget(self) -> None:
+        '''The largest files start first, with smaller ones filling the rest of the budget'''
+        scheduler = uvtt2fgu.MemoryScheduler([10, 60, 50, 30], 100, 3)
+        self.assertEqual(scheduler.start(), [1, 3, 0])
+        self.assertEqual(scheduler.start(), [])
+        scheduler.finished(1)
+        self.assertEqual(scheduler.start(), [2])
+        self.assertEqual(scheduler.used, 90)
+
+    def test_over_budget(self) -> None:
+        '''A file bigger than the budget runs on its own'''
+        scheduler = uvtt2fgu.MemoryScheduler([10, 500], 100, 4)
+        self.assertEqual(scheduler.start(), [1])
+        self.assertEqual(scheduler.start(), [])
+        scheduler.finished(1)
+        self.assertEqual(scheduler.start(), [0])
+
+    def test_estimate(self) -> None:
+        '''The image size comes from the PNG header'''
+        filepath = Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt'
+        uvtt2fgu.loadConfigData(None)
+        uvtt2fgu.configData.streaming = True
+        # The sample map is an RGBA PNG, so the .jpg needs an RGB copy too
+        self.assertEqual(uvtt2fgu.estimateMemory(filepath), 2 * 4 * 2560 * 2560)
+        self.assertEqual(uvtt2fgu.estimateMemory(filepath, writeImages=False), 0)
+        uvtt2fgu.configData.streaming = False
+        self.assertEqual(uvtt2fgu.estimateMemory(filepath, writeImages=False), 2 * filepath.stat().st_size)
+
+class TestCheck(OutputTestCase):
+    def test_samplemap(self) -> None:
+        '''The geometry is counted without decoding the image'''
+        with mock.patch.object(uvtt2fgu.binascii, 'a2b_base64') as a2b_base64:
+            uvttfile = uvtt2fgu.UVTTFile(self.samplePath, '25%', '0px', loadImage=False)
+            (counts, problems) = uvttfile.checkGeometry()
+        a2b_base64.assert_not_called()
+        self.assertEqual(counts, {'occluders': 7, 'points': 79, 'lights': 2})
+        self.assertEqual(problems, [])
+
+    def test_problems(self) -> None:
+        with self.samplePath.open() as f:
+            data = json.load(f)
+        del data['portals']
+        data['lights'][0]['position'] = {'x': 0, 'y': 0}
+        uvttfile = uvtt2fgu.UVTTFile(json.dumps(data).encode('utf-8'), '25%', '0px', loadImage=False)
+        (counts, problems) = uvttfile.checkGeometry()
+        self.assertEqual(counts, {})
+        self.assertEqual(problems, ['no portals section', '1 points in lights are outside the map'])
+
+    def test_collisions(self) -> None:
+        '''Outputs written by two files, or that already exist, are reported'''
+        otherdir = self.outdir / 'other'
+        otherdir.mkdir()
+        shutil.copy(self.samplePath, otherdir)
+        (self.outdir / 'sampleMap.xml').touch()
+        jobs = [uvtt2fgu.composeFilePaths(self.samplePath), uvtt2fgu.composeFilePaths(otherdir / 'sampleMap.dd2vtt')]
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            exitcode = uvtt2fgu.checkFiles(jobs, '25%', '0px')
+        self.assertEqual(exitcode, errno.EINVAL)
+        lines = stdout.getvalue().splitlines()
+        self.assertIn('  {} already exists'.format(self.outdir / 'sampleMap.xml'), lines)
+        self.assertIn('  {} is also written by {}'.format(self.outdir / 'sampleMap.png', self.samplePath), lines)
+
+    def test_unreadable(self) -> None:
+        '''A file that cannot be read is logged, not printed in the report'''
+        badpath = self.outdir / 'bad.dd2vtt'
+        badpath.write_text('{"resolution": ')
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout, self.assertLogs(level='ERROR') as logs:
+            exitcode = uvtt2fgu.checkFiles([uvtt2fgu.composeFilePaths(badpath)], '25%', '0px')
+        self.assertEqual(exitcode, errno.EIO)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('bad.dd2vtt', logs.output[0])
+
+class TestConversionStats(OutputTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(uvtt2fgu.tracemalloc.stop)
+        return super().setUp()
+
+    def test_nested(self) -> None:
+        '''An enclosing stage includes the memory and time of the stages inside it'''
+        stats = uvtt2fgu.ConversionStats()
+        output = self.outdir / 'out.bin'
+        with stats.file(Path('map.dd2vtt')):
+            with stats.stage('write', output):
+                data = bytearray(4 * 1024 * 1024)
+                output.write_bytes(data)
+                del data
+        (write, total) = stats.records
+        self.assertEqual((write['stage'], total['stage']), ('write', 'total'))
+        self.assertEqual(write['file'], 'map.dd2vtt')
+        self.assertEqual(write['bytes'], 4 * 1024 * 1024)
+        self.assertIsNone(total['bytes'])
+        self.assertGreaterEqual(write['peak'], 4 * 1024 * 1024)
+        self.assertGreaterEqual(total['peak'], write['peak'])
+        self.assertGreaterEqual(total['wall'], write['wall'])
+        self.assertEqual(stats.summary()[1].split()[:2], ['write', '1'])
+
+    def test_processFiles(self) -> None:
+        '''The stages are recorded in worker processes and written as JSON lines'''
+        uvtt2fgu.configData.writejpg = False
+        uvtt2fgu.configData.jobs = 2
+        jobs = [self.copySample(name) for name in ('a', 'b')]
+        stats = uvtt2fgu.ConversionStats(self.outdir / 'stats.jsonl')
+        self.assertEqual(uvtt2fgu.processFiles(jobs, '25%', '0px', stats=stats), 0)
+        with (self.outdir / 'stats.jsonl').open() as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records, stats.records)
+        stages = [record['stage'] for record in records if record['file'].endswith('a.dd2vtt')]
+        self.assertEqual(stages, ['json_load', 'base64_decode', 'write_png', 'write_xml', 'total'])
+
+class TestModuleWriter(OutputTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.jobs = [self.copySample(name) for name in ('a', 'b')]
+
+    def convert(self, jobs: int, expected: int = 0) -> dict:
+        uvtt2fgu.configData.jobs = jobs
+        module = uvtt2fgu.ModuleWriter(self.outdir / 'maps.mod')
+        try:
+            exitcode = uvtt2fgu.processFiles(self.jobs, '25%', '0px', module=module)
+        finally:
+            module.close()
+        self.assertEqual(exitcode, expected)
+        # The spooled entries are cleaned up, whether or not their map converted
+        self.assertFalse(module.spoolDirectory.exists())
+        with uvtt2fgu.zipfile.ZipFile(self.outdir / 'maps.mod') as archive:
+            return {info.filename: (info.compress_type, archive.read(info)) for info in archive.infolist()}
+
+    def test_serial(self) -> None:
+        '''The images are stored and the .xml deflated, with nothing written outside the module'''
+        entries = self.convert(1)
+        self.assertEqual(list(entries), ['images/a.png', 'images/a.jpg', 'images/a.xml',
+                                         'images/b.png', 'images/b.jpg', 'images/b.xml'])
+        self.assertEqual(entries['images/a.png'][0], uvtt2fgu.zipfile.ZIP_STORED)
+        self.assertEqual(entries['images/a.jpg'][0], uvtt2fgu.zipfile.ZIP_STORED)
+        self.assertEqual(entries['images/a.xml'][0], uvtt2fgu.zipfile.ZIP_DEFLATED)
+        self.assertFalse((self.outdir / 'a.png').exists())
+        self.assertFalse((self.outdir / 'a.xml').exists())
+
+        # The same as the separate files
+        uvtt2fgu.processFiles(self.jobs[:1], '25%', '0px')
+        for suffix in ('.png', '.jpg', '.xml'):
+            self.assertEqual(entries['images/a' + suffix][1], (self.outdir / ('a' + suffix)).read_bytes())
+
+    def test_parallel(self) -> None:
+        '''Files converted in worker processes are written in order by this process'''
+        self.assertEqual(self.convert(2), self.convert(1))
+
+    def test_memory_budget(self) -> None:
+        '''Files converted under a memory budget are written into the module as they finish'''
+        uvtt2fgu.configData.maxMemory = 1
+        self.assertEqual(self.convert(2), self.convert(1))
+
+    def test_failed_map(self) -> None:
+        '''A map that fails part way through leaves nothing in the module'''
+        with self.samplePath.open() as f:
+            data = json.load(f)
+        data['image'] = base64.b64encode(b'\x89PNG\r\n\x1a\n' + bytes(100)).decode('ascii')
+        badpath = self.outdir / 'bad.dd2vtt'
+        badpath.write_text(json.dumps(data))
+        self.jobs.insert(1, uvtt2fgu.composeFilePaths(badpath))
+        for jobs in (1, 2):
+            entries = self.convert(jobs, errno.EIO)
+            self.assertEqual([name for name in entries if 'bad' in name], [])
+            self.assertIn('images/b.xml', entries)
+
+    def test_spooled_entries(self) -> None:
+        '''Entries are spooled next to the module and each removed once copied into it'''
+        module = uvtt2fgu.ModuleWriter(self.outdir / 'maps.mod')
+        try:
+            self.assertEqual(module.spoolDirectory.parent, self.outdir)
+            collector = uvtt2fgu.ModuleEntryCollector(module.spoolDirectory)
+            collector.writeEntry(self.outdir / 'a.xml', lambda f: f.write(b'<root/>'), True)
+            (_, spoolpath, _) = collector.entries[0]
+            self.assertEqual(spoolpath.read_bytes(), b'<root/>')
+            module.addEntries(collector.entries)
+            self.assertFalse(spoolpath.exists())
+
+            collector = uvtt2fgu.ModuleEntryCollector(module.spoolDirectory)
+            collector.writeEntry(self.outdir / 'b.xml', lambda f: f.write(b'<root/>'), True)
+            collector.discard()
+            self.assertEqual(list(module.spoolDirectory.iterdir()), [])
+        finally:
+            module.close()
+        with uvtt2fgu.zipfile.ZipFile(self.outdir / 'maps.mod') as archive:
+            self.assertEqual(archive.namelist(), ['images/a.xml'])
+            self.assertEqual(archive.read('images/a.xml'), b'<root/>')
+
+class TestWatchFolder(OutputTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.watchdir = self.outdir
+        uvtt2fgu.configData.writejpg = False
+        uvtt2fgu.configData.watchInterval = 0
+
+    def test_poll(self) -> None:
+        '''A file is reported once its size is stable and its JSON is complete'''
+        watcher = uvtt2fgu.WatchFolder(self.watchdir)
+        filepath = self.watchdir / 'map.dd2vtt'
+        filepath.write_text('{"resolution": ')
+        (self.watchdir / 'notes.txt').write_text('{}')
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+
+        with filepath.open('a') as f:
+            f.write('{}}\n')
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [filepath])
+        self.assertEqual(watcher.poll(), [])
+
+        # A new export of the same map is reported again
+        filepath.write_text('{"resolution": {}}')
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [filepath])
+
+    def test_watch(self) -> None:
+        '''A map saved into the directory is converted once'''
+        shutil.copy(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', self.watchdir)
+        with mock.patch.object(uvtt2fgu, 'processFileSafe', wraps=uvtt2fgu.processFileSafe) as processFileSafe:
+            exitcode = uvtt2fgu.watchFolder(self.watchdir, '25%', '0px', polls=4)
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(processFileSafe.call_count, 1)
+        self.assertTrue((self.watchdir / 'sampleMap.xml').exists())
+        self.assertTrue((self.watchdir / 'sampleMap.png').exists())
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs POSIX process groups')
+    def test_interrupt(self) -> None:
+        '''Ctrl-C stops watching cleanly, leaving each map either fully converted or not at all'''
+        config = self.watchdir / 'uvtt2fgu.conf'
+        config.write_text('[default]\nxmlpath = {0}\npngpath = {0}\njpgpath = {0}\n'.format(self.watchdir))
+        outputs = [self.watchdir / ('sampleMap' + suffix) for suffix in ('.png', '.jpg', '.xml')]
+        for jobs in ('1', '2'):
+            for filepath in outputs:
+                if filepath.exists():
+                    filepath.unlink()
+            # Ctrl-C in a terminal signals the whole process group
+            process = subprocess.Popen([sys.executable, str(Path(uvtt2fgu.__file__)), '-c', str(config), '-j', jobs,
+                                        '--watch', str(self.watchdir), '--watchinterval', '0.05'],
+                                       stderr=subprocess.PIPE, text=True, start_new_session=True)
+            self.addCleanup(process.kill)
+            shutil.copy(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', self.watchdir)
+            # Interrupt as soon as the map has started writing its outputs
+            deadline = time.monotonic() + 30
+            while not outputs[0].exists() and time.monotonic() < deadline:
+                time.sleep(0.001)
+            os.killpg(process.pid, signal.SIGINT)
+            (_, stderr) = process.communicate(timeout=30)
+
+            self.assertEqual(process.returncode, 0, stderr)
+            self.assertNotIn('Traceback', stderr)
+            self.assertIn([filepath.exists() for filepath in outputs], ([True] * 3, [False] * 3))
+
+class TestConvert(unittest.TestCase):
+    def setUp(self) -> None:
+        self.source = (Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt').read_bytes()
+        # The library API must not depend on the configuration file
+        patcher = mock.patch.object(uvtt2fgu, 'configData', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return super().setUp()
+
+    def test_bytes(self) -> None:
+        '''The outputs are returned as bytes'''
+        options = uvtt2fgu.ConversionOptions(writejpg=False)
+        result = uvtt2fgu.convert(self.source, options)
+        self.assertIsNone(result.jpg)
+        self.assertEqual(result.png, base64.b64decode(json.loads(self.source)['image']))
+        root = ET.fromstring(result.xml)
+        self.assertEqual(root.find('gridsize').text, '{0},{0}'.format(result.gridsize))
+
+    def test_streams(self) -> None:
+        '''The outputs are written to the caller's streams, which are left open'''
+        options = uvtt2fgu.ConversionOptions(writejpg=False)
+        (xml, png) = (BytesIO(), BytesIO())
+        result = uvtt2fgu.convert(BytesIO(self.source), options, xml=xml, png=png)
+        self.assertIsNone(result.xml)
+        self.assertIsNone(result.png)
+        expected = uvtt2fgu.convert(self.source, options)
+        self.assertEqual(xml.getvalue(), expected.xml)
+        self.assertEqual(png.getvalue(), expected.png)
+
+    def test_threads(self) -> None:
+        '''Conversions with different options can run at the same time'''
+        from concurrent.futures import ThreadPoolExecutor
+
+        def terrainCount(objectsAreTerrain):
+            options = uvtt2fgu.ConversionOptions(writepng=False, writejpg=False,
+                                                 objectsAreTerrain=objectsAreTerrain)
+            result = uvtt2fgu.convert(self.source, options)
+            return len(ET.fromstring(result.xml).findall('.//terrain'))
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            counts = list(executor.map(terrainCount, [True, False] * 4))
+        self.assertEqual(counts, [1, 0] * 4)
+
+    def test_unknown_option(self) -> None:
+        with self.assertRaises(TypeError):
+            uvtt2fgu.ConversionOptions(jpgQualty=90)
+
+class TestConvertMany(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filepaths = []
+        for name in ('a', 'b', 'c', 'd'):
+            filepath = Path(self.tmpdir.name) / (name + '.dd2vtt')
+            shutil.copy(Path(__file__).parent / 'exampleMaps' / 'sampleMap.dd2vtt', filepath)
+            self.filepaths.append(filepath)
+        self.badpath = Path(self.tmpdir.name) / 'bad.dd2vtt'
+        self.badpath.write_text('{"resolution": ')
+        return super().setUp()
+
+    def collect(self, filepaths, **kwargs):
+        async def run():
+            options = uvtt2fgu.ConversionOptions(writepng=False, writejpg=False)
+            return [item async for item in uvtt2fgu.convertMany(filepaths, options, **kwargs)]
+        return asyncio.run(run())
+
+    def test_results(self) -> None:
+        '''Every file is yielded once, and a bad file does not stop the rest'''
+        with self.assertLogs(level='ERROR'):
+            results = dict(self.collect(self.filepaths + [self.badpath], concurrency=2))
+        self.assertEqual(set(results), set(self.filepaths + [self.badpath]))
+        self.assertIsNone(results[self.badpath])
+        for filepath in self.filepaths:
+            self.assertTrue(results[filepath].xml.startswith(b'<?xml'))
+
+    def test_concurrency(self) -> None:
+        '''No more than the given number of files are converted at once'''
+        lock = threading.Lock()
+        counts = {'running': 0, 'most': 0}
+        convert = uvtt2fgu.convert
+
+        def countingConvert(*args, **kwargs):
+            with lock:
+                counts['running'] += 1
+                counts['most'] = max(counts['most'], counts['running'])
+            try:
+                time.sleep(0.05)
+                return convert(*args, **kwargs)
+            finally:
+                with lock:
+                    counts['running'] -= 1
+
+        with mock.patch.object(uvtt2fgu, 'convert', countingConvert):
+            results = self.collect(self.filepaths, concurrency=2)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(counts['most'], 2)
+
+    def test_bad_concurrency(self) -> None:
+        '''A concurrency below one is rejected rather than waiting on nothing'''
+        with self.assertRaisesRegex(ValueError, 'concurrency'):
+            self.collect(self.filepaths, concurrency=0)
+
+class TestLazyImports(unittest.TestCase):
+    def test_startup(self) -> None:
+        '''Importing the module and parsing the command line do not import the heavy modules'''
+        code = '\n'.join([
+            'import sys, uvtt2fgu',
+            'uvtt2fgu.init_argparse().parse_args(["-f", "map.dd2vtt"])',
+            'print(" ".join(name for name in ("PIL", "numpy", "asyncio", "concurrent.futures", "zipfile") if name in sys.modules))',
+        ])
+        result = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parent,
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+    def test_optional(self) -> None:
+        '''A missing optional module tests as false'''
+        self.assertFalse(uvtt2fgu.LazyModule('uvtt2fgu_missing_module', optional=True))
+        with self.assertRaises(ImportError):
+            uvtt2fgu.LazyModule('uvtt2fgu_missing_module').anything
+
+class TestBenchmark(unittest.TestCase):
+    def test_generateMap(self) -> None:
+        '''A synthetic map converts, and each stage is timed'''
+        import benchmark_uvtt2fgu
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = Path(tmpdir) / 'synthetic.dd2vtt'
+            benchmark_uvtt2fgu.generateMap(filepath, size=(4, 3), gridsize=10, walls=5, objects=2, portals=3, lights=4)
+            case = benchmark_uvtt2fgu.benchmarkFile(filepath, Path(tmpdir), 1)
+            self.assertEqual(case['resolution'], [4, 3])
+            self.assertEqual((case['walls'], case['objects'], case['portals'], case['lights']), (5, 2, 3, 4))
+            self.assertLessEqual(set(case['stages']), set(benchmark_uvtt2fgu.stages))
+            self.assertIn('json_load', case['stages'])
+            with uvtt2fgu.Image.open(Path(tmpdir) / 'synthetic.png') as image:
+                self.assertEqual(image.size, (40, 30))
+
 if __name__ == '__main__':
     unittest.main()
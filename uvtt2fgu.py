@@ -1,24 +1,200 @@
 #!/usr/bin/env python3
 
+# Annotations are not evaluated, so that naming a lazily imported module in
+# them does not import it
+from __future__ import annotations
+
 import argparse
-import base64
+from array import array
+import binascii
+from collections import deque
 import configparser
+from contextlib import contextmanager, nullcontext
 import errno
-from io import BytesIO
+import importlib
+from io import BytesIO, TextIOWrapper
+from itertools import repeat
 import json
 import logging
-from math import sin, cos
+from math import gcd, sin, cos
+import mmap
+import os
 from os import getenv, remove
 from pathlib import Path
 import platform
+import shutil
+import signal
+import struct
 import sys
-from typing import Optional, Tuple
-from PIL import Image
+import time
+from typing import AsyncIterator, BinaryIO, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import zlib
+
+
+class LazyModule(object):
+    '''Stands in for a module, which is only imported the first time it is used
+
+    An optional module that is not installed tests as false.
+    '''
+
+    def __init__(self, name: str, optional: bool = False) -> None:
+        # Named so as not to hide any of the module's own attributes
+        object.__setattr__(self, 'lazyName', name)
+        object.__setattr__(self, 'lazyOptional', optional)
+        object.__setattr__(self, 'lazyModule', None)
+
+    def lazyLoad(self):
+        '''Import the module, or return False for a missing optional module'''
+        if self.lazyModule is None:
+            try:
+                module = importlib.import_module(self.lazyName)
+            except ImportError:
+                if not self.lazyOptional:
+                    raise
+                module = False
+            object.__setattr__(self, 'lazyModule', module)
+        return self.lazyModule
+
+    def __getattr__(self, attribute: str):
+        module = self.lazyLoad()
+        if module is False:
+            raise AttributeError('{} is not installed'.format(self.lazyName))
+        return getattr(module, attribute)
+
+    def __setattr__(self, attribute: str, value) -> None:
+        setattr(self.lazyLoad(), attribute, value)
+
+    def __delattr__(self, attribute: str) -> None:
+        delattr(self.lazyLoad(), attribute)
+
+    def __bool__(self) -> bool:
+        return self.lazyLoad() is not False
+
+
+asyncio = LazyModule('asyncio')
+base64 = LazyModule('base64')
+concurrentFutures = LazyModule('concurrent.futures')
+hashlib = LazyModule('hashlib')
+Image = LazyModule('PIL.Image')
+np = LazyModule('numpy', optional=True)
+orjson = LazyModule('orjson', optional=True)
+tempfile = LazyModule('tempfile')
+tracemalloc = LazyModule('tracemalloc')
+zipfile = LazyModule('zipfile')
+
+def parseByteSize(size: str) -> int:
+    '''Converts a size such as 1500000, 800K or 2M to a number of bytes'''
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper()
+    if size[-1:] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def parseImageSize(size: str) -> Tuple[int, int]:
+    '''Converts a size such as 256x256 to a width and height'''
+    try:
+        (width, height) = (int(value) for value in size.lower().split('x'))
+    except ValueError:
+        raise ValueError('size must be WIDTHxHEIGHT, such as 256x256')
+    if width < 1 or height < 1:
+        raise ValueError('size must be at least 1x1')
+    return (width, height)
+
+
+def hasAlpha(image: Image.Image) -> bool:
+    '''Whether an image has any transparency'''
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+
+class ImageEncoder(object):
+    '''An additional image format, turned on with write<name> and written by its save(image, filepath)'''
+    name = None
+    suffix = None
+
+    def __init__(self, settings: dict) -> None:
+        self.path = settings.get(self.name + 'path')
+
+    def settings(self) -> dict:
+        '''The settings that affect the content of the output file'''
+        return {name: value for name, value in vars(self).items() if name != 'path'}
 
-class ConfigFileData(object):
+    def imageMode(self, image: Image.Image) -> Optional[str]:
+        '''The mode to convert the decoded image to, None to use it as it is'''
+        return None
+
+
+class WebpEncoder(ImageEncoder):
+    '''Lossy WebP, usually much smaller than a .jpg of the same quality'''
+    name = 'webp'
+    suffix = '.webp'
+    lossless = False
+
+    def __init__(self, settings: dict) -> None:
+        super().__init__(settings)
+        self.quality = int(settings.get(self.name + 'quality', 80))
+        self.method = int(settings.get(self.name + 'method', 4))
+
+    def imageMode(self, image: Image.Image) -> Optional[str]:
+        return 'RGBA' if hasAlpha(image) else 'RGB'
+
+    def save(self, image: Image.Image, filepath: Path) -> None:
+        image.save(filepath, format='WEBP', lossless=self.lossless, quality=self.quality, method=self.method)
+
+
+class WebpLosslessEncoder(WebpEncoder):
+    '''Lossless WebP, where the quality is the compression effort'''
+    name = 'webplossless'
+    suffix = '-lossless.webp'
+    lossless = True
+
+
+class OptimizedPngEncoder(ImageEncoder):
+    '''The .png re-compressed with the highest compression Pillow offers'''
+    name = 'optpng'
+    suffix = '-optimized.png'
+
+    def __init__(self, settings: dict) -> None:
+        super().__init__(settings)
+        self.compressLevel = int(settings.get('optpngcompresslevel', 9))
+
+    def save(self, image: Image.Image, filepath: Path) -> None:
+        image.save(filepath, format='PNG', optimize=True, compress_level=self.compressLevel)
+
+
+imageEncoders = [WebpEncoder, WebpLosslessEncoder, OptimizedPngEncoder]
+
+
+class ConversionOptions(object):
+    '''The settings that control how a map is converted, given as keyword arguments'''
+
+    def __init__(self, **kwargs) -> None:
+        self.portalWidth = '25%'
+        self.portalLength = '0px'
+        self.writejpg = True
+        self.writepng = True
+        self.objectsAreTerrain = True
+        self.jpgQuality = 75
+        self.jpgOptimize = True
+        self.jpgSubsampling = 2
+        self.jpgMaxBytes = 0
+        self.thumbnailSize = None
+        self.streaming = False
+        self.jsonBackend = 'auto'
+        self.simplify = None
+        self.mergeWalls = False
+        self.encoders = []
+
+        for name, value in kwargs.items():
+            if not hasattr(self, name):
+                raise TypeError('Unknown conversion option {}'.format(name))
+            setattr(self, name, value)
+
+
+class ConfigFileData(ConversionOptions):
     def __init__(self, configFile: str) -> None:
+        super().__init__()
         if not configFile:
             configFile = self.configFilePath() / 'uvtt2fgu.conf'
 
@@ -29,17 +205,21 @@ class ConfigFileData(object):
 
         self.xmlpath = None
         self.jpgpath = None
-        self.writejpg = True
         self.pngpath = None
-        self.writepng = True
         self.forceOverwrite = None
         self.remove = None
         self.alllocaldd2vttfiles = False
-        self.objectsAreTerrain = True
-        self.jpgQuality = 75
-        self.jpgOptimize = True
-        self.jpgSubsampling = 2
         self.maxImageFileSize = None
+        self.jobs = 1
+        self.maxMemory = 0
+        self.watchInterval = 2.0
+        self.cache = False
+        self.tileSize = 0
+        self.tileLevels = 0
+        self.profile = False
+        self.statsPath = None
+        self.module = None
+        self.encoderSettings = {}
 
         for section in config.sections():
             self.xmlpath = config[section].get('xmlpath')
@@ -55,6 +235,31 @@ class ConfigFileData(object):
             self.jpgOptimize = config[section].getboolean('jpgoptimize', True)
             self.jpgSubsampling = config[section].getint('jpgsubsampling', 2)
             self.maxImageFileSize = config[section].get('maximagefilesize')
+            self.jobs = config[section].getint('jobs', 1)
+            self.maxMemory = parseByteSize(config[section].get('maxmemory', '0'))
+            self.streaming = config[section].getboolean('streaming', False)
+            self.jsonBackend = config[section].get('jsonbackend', 'auto')
+            self.watchInterval = config[section].getfloat('watchinterval', 2.0)
+            self.cache = config[section].getboolean('cache', False)
+            self.simplify = config[section].get('simplify')
+            self.mergeWalls = config[section].getboolean('mergewalls', False)
+            self.tileSize = config[section].getint('tilesize', 0)
+            self.tileLevels = config[section].getint('tilelevels', 0)
+            self.profile = config[section].getboolean('profile', False)
+            self.statsPath = config[section].get('stats')
+            self.module = config[section].get('module')
+            self.jpgMaxBytes = parseByteSize(config[section].get('jpgmaxbytes', '0'))
+            thumbnail = config[section].get('thumbnail')
+            self.thumbnailSize = parseImageSize(thumbnail) if thumbnail else None
+            self.encoderSettings = dict(config[section])
+            self.encoders = [encoder(self.encoderSettings) for encoder in imageEncoders
+                             if config[section].getboolean('write' + encoder.name, False)]
+
+    def enableEncoder(self, name: str) -> None:
+        '''Turn on one of the additional image encoders, if it is not already on'''
+        if not any(encoder.name == name for encoder in self.encoders):
+            encoder = next(encoder for encoder in imageEncoders if encoder.name == name)
+            self.encoders.append(encoder(self.encoderSettings))
 
     def configFilePath(self) -> Path:
         myPlatform = platform.system()
@@ -83,6 +288,8 @@ def composeId(id: int) -> ET.Element:
 
 
 class Point(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x: float, y: float):
         # FGU only wants 1 decimal point
         self.x = round(x, 1)
@@ -103,6 +310,172 @@ def translatePortalAdjustment(gridsize: int, adjustment: str) -> float:
     return val
 
 
+def translateTolerance(gridsize: int, tolerance: str) -> float:
+    '''Converts from a tolerance value to the actual pixel count
+
+    Either ##% of the grid size, or a ##px literal pixels
+    '''
+    if tolerance[-1] == '%':
+        val = gridsize * float(tolerance[:-1]) / 100
+    elif tolerance[-2:] == 'px':
+        val = float(tolerance[:-2])
+    else:
+        raise ValueError('Invalid input: {}'.format(tolerance))
+
+    return val
+
+
+def simplifyPolyline(coords, tolerance: float, pinned: set) -> list:
+    '''Reduce the points of a polyline with the Douglas-Peucker algorithm, always keeping its ends and pinned points'''
+    count = len(coords) // 2
+    if count <= 2:
+        return list(coords)
+
+    keep = bytearray(count)
+    keep[0] = keep[-1] = 1
+    for i in range(1, count - 1):
+        if (coords[2 * i], coords[2 * i + 1]) in pinned:
+            keep[i] = 1
+
+    kept = [i for i in range(count) if keep[i]]
+    stack = list(zip(kept, kept[1:]))
+    toleranceSq = tolerance * tolerance
+
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+
+        ax, ay = coords[2 * first], coords[2 * first + 1]
+        dx, dy = coords[2 * last] - ax, coords[2 * last + 1] - ay
+        lengthSq = dx * dx + dy * dy
+
+        furthest = None
+        furthestSq = toleranceSq
+        for i in range(first + 1, last):
+            px, py = coords[2 * i] - ax, coords[2 * i + 1] - ay
+            # Distance to the segment, which is just a point for closed loops
+            t = (px * dx + py * dy) / lengthSq if lengthSq else 0
+            t = min(max(t, 0), 1)
+            ex, ey = px - t * dx, py - t * dy
+            distSq = ex * ex + ey * ey
+            if distSq > furthestSq:
+                furthest = i
+                furthestSq = distSq
+
+        if furthest is not None:
+            keep[furthest] = 1
+            stack.append((first, furthest))
+            stack.append((furthest, last))
+
+    simplified = []
+    for i in range(count):
+        if keep[i]:
+            simplified.append(coords[2 * i])
+            simplified.append(coords[2 * i + 1])
+    return simplified
+
+
+def mergeWalls(polylines: list) -> list:
+    '''Merge walls, as interleaved x, y pixel coordinates, into as few polylines as possible'''
+    points = {}
+    lines = {}
+    for coords in polylines:
+        keys = []
+        for x, y in zip(coords[0::2], coords[1::2]):
+            # Tenths of a pixel, the precision of the translated coordinates,
+            # so the geometry below is exact integer arithmetic
+            key = (round(x * 10), round(y * 10))
+            points.setdefault(key, (x, y))
+            keys.append(key)
+
+        for p, q in zip(keys, keys[1:]):
+            if p == q:
+                continue
+
+            # The line through the segment, as a reduced direction and the
+            # offset of the line from the origin
+            dx, dy = q[0] - p[0], q[1] - p[1]
+            divisor = gcd(dx, dy)
+            dx, dy = dx // divisor, dy // divisor
+            if dx < 0 or (dx == 0 and dy < 0):
+                dx, dy = -dx, -dy
+            line = (dx, dy, dy * p[0] - dx * p[1])
+
+            tp, tq = dx * p[0] + dy * p[1], dx * q[0] + dy * q[1]
+            if tp > tq:
+                (p, q, tp, tq) = (q, p, tq, tp)
+            lines.setdefault(line, []).append((tp, tq, p, q))
+
+    segments = []
+    for intervals in lines.values():
+        intervals.sort()
+        (_, end, p, q) = intervals[0]
+        for (t1, t2, p1, q1) in intervals[1:]:
+            if t1 <= end:
+                if t2 > end:
+                    (end, q) = (t2, q1)
+            else:
+                segments.append((p, q))
+                (end, p, q) = (t2, p1, q1)
+        segments.append((p, q))
+
+    ends = {}
+    for i, (p, q) in enumerate(segments):
+        ends.setdefault(p, []).append(i)
+        ends.setdefault(q, []).append(i)
+    used = bytearray(len(segments))
+
+    def walk(point, i):
+        '''Follow unused segments from point, through any junctions, until there are none left'''
+        chain = [point]
+        while True:
+            used[i] = 1
+            (p, q) = segments[i]
+            point = q if p == point else p
+            chain.append(point)
+            i = next((j for j in ends[point] if not used[j]), None)
+            if i is None:
+                return chain
+
+    chains = []
+    # Each chain from a point where an odd number of segments meet ends at
+    # another such point
+    for point, joined in ends.items():
+        if len(joined) % 2:
+            for i in joined:
+                if not used[i]:
+                    chains.append(walk(point, i))
+    # Anything left is made of closed loops, which are spliced into a chain
+    # that passes through them where there is one
+    chainAt = {point: chain for chain in chains for point in chain}
+    for i, (p, q) in enumerate(segments):
+        if used[i]:
+            continue
+        loop = walk(p, i)
+        for k, point in enumerate(loop[:-1]):
+            if point in chainAt:
+                chain = chainAt[point]
+                at = chain.index(point)
+                chain[at:at + 1] = loop[k:-1] + loop[:k + 1]
+                break
+        else:
+            chain = loop
+            chains.append(chain)
+        chainAt.update((point, chain) for point in loop)
+
+    if len(chains) > len(polylines):
+        return polylines
+
+    merged = []
+    for chain in chains:
+        coords = []
+        for key in chain:
+            coords.extend(points[key])
+        merged.append(coords)
+    return merged
+
+
 def convertLineToRect(line, width, length, angle):
     '''Essentially turns a line into a fat line'''
     widthModifyX = width * sin(angle)
@@ -134,11 +507,450 @@ def convertLineToRect(line, width, length, angle):
     return points
 
 
+def copyImageFile(src: BinaryIO, dst: BinaryIO) -> None:
+    '''Copy the whole decoded image in src to dst without copying it into Python bytes'''
+    if isinstance(src, BytesIO):
+        # getvalue() hands back the original bytes object while it is unmodified
+        dst.write(src.getvalue())
+        return
+
+    src.flush()
+    dst.flush()
+    srcfd = src.fileno()
+    try:
+        dstfd = dst.fileno()
+    except (OSError, ValueError):
+        # Not a real file, such as a BytesIO
+        dstfd = None
+    size = os.fstat(srcfd).st_size
+    offset = 0
+
+    for copy in ('copy_file_range', 'sendfile'):
+        if offset >= size or dstfd is None or not hasattr(os, copy):
+            continue
+        try:
+            while offset < size:
+                if copy == 'copy_file_range':
+                    copied = os.copy_file_range(srcfd, dstfd, size - offset, offset_src=offset)
+                else:
+                    copied = os.sendfile(dstfd, srcfd, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            # Not supported between these files, try the next method
+            continue
+
+    if offset < size:
+        with mmap.mmap(srcfd, 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm)[offset:] as view:
+                dst.write(view)
+
+
+class PngBandReader(object):
+    '''Decode a non-interlaced, 8 bit per channel PNG image a band of rows at a time'''
+    signature = b'\x89PNG\r\n\x1a\n'
+    # Channels per pixel for each PNG color type
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+    # Pillow's mode for each PNG color type, also its raw mode at 8 bits per channel
+    modes = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+    # The most data a stored deflate block can hold
+    blockSize = 0xffff
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        if f.read(len(self.signature)) != self.signature:
+            raise ValueError('Not a PNG image')
+
+        self.palette = None
+        (chunkType, data) = self.readChunk()
+        if chunkType != b'IHDR':
+            raise ValueError('PNG image does not start with a header')
+        (self.width, self.height, bitDepth, self.colorType, _, _, interlace) = struct.unpack('>IIBBBBB', data)
+
+        # Keep the chunks needed to decode the pixels, up to the image data
+        while True:
+            (chunkType, data) = self.readChunk()
+            if chunkType == b'IDAT':
+                self.firstData = data
+                break
+            if chunkType == b'IEND':
+                raise ValueError('PNG image has no image data')
+            if chunkType == b'PLTE':
+                self.palette = data
+
+        self.supported = bitDepth == 8 and interlace == 0 and self.colorType in self.channels
+        if self.supported:
+            self.rowBytes = 1 + self.width * self.channels[self.colorType]
+
+    def readChunk(self) -> Tuple[bytes, bytes]:
+        header = self.f.read(8)
+        if len(header) < 8:
+            raise ValueError('Truncated PNG image')
+        (length, chunkType) = struct.unpack('>I4s', header)
+        data = self.f.read(length)
+        if len(data) < length:
+            raise ValueError('Truncated PNG image')
+        self.f.read(4)
+        return (chunkType, data)
+
+    def compressedData(self):
+        '''Generate the contents of the consecutive IDAT chunks'''
+        yield self.firstData
+        while True:
+            (chunkType, data) = self.readChunk()
+            if chunkType != b'IDAT':
+                return
+            yield data
+
+    def bands(self, rows: int):
+        '''Generate (top, image) for each band of up to rows rows'''
+        if not self.supported:
+            raise ValueError('Unsupported PNG format for band decoding')
+
+        inflater = zlib.decompressobj()
+        source = self.compressedData()
+        previous = None
+
+        for top in range(0, self.height, rows):
+            count = min(rows, self.height - top)
+            needed = count * self.rowBytes
+            blocks = []
+            while needed:
+                data = inflater.unconsumed_tail or next(source, None)
+                block = inflater.decompress(data or b'', min(needed, self.blockSize))
+                if data is None and not block:
+                    raise ValueError('Truncated PNG image data')
+                if block:
+                    blocks.append(block)
+                    needed -= len(block)
+
+            band = self.decodeBand(previous, blocks, count)
+            previous = band.crop((0, count - 1, self.width, count)).tobytes()
+            yield (top, band)
+
+    @classmethod
+    def storedZlib(cls, blocks: List[bytes]) -> bytes:
+        '''Wrap data in a zlib stream of stored blocks, without compressing or copying it more than once'''
+        parts = [b'\x78\x01']
+        adler = 1
+        for block in blocks:
+            view = memoryview(block)
+            for offset in range(0, len(view), cls.blockSize):
+                data = view[offset:offset + cls.blockSize]
+                parts += [struct.pack('<BHH', 0, len(data), len(data) ^ 0xffff), data]
+                adler = zlib.adler32(data, adler)
+        # An empty final block ends the stream
+        parts += [struct.pack('<BHH', 1, 0, 0xffff), struct.pack('>I', adler)]
+        return b''.join(parts)
+
+    def decodeBand(self, previous: Optional[bytes], blocks: List[bytes], count: int) -> Image.Image:
+        '''Decode one band of filtered rows'''
+        # Pillow's PNG row decoder reads a zlib stream, so the rows are
+        # handed to it stored uncompressed, after the last decoded row of the
+        # band before, unfiltered, for filters to refer to
+        if previous is not None:
+            blocks = [b'\x00' + previous] + blocks
+            count += 1
+
+        mode = self.modes[self.colorType]
+        image = Image.frombytes(mode, (self.width, count), self.storedZlib(blocks), 'zip', mode)
+        if self.palette is not None:
+            image.putpalette(self.palette)
+        if previous is not None:
+            image = image.crop((0, 1, self.width, count))
+        return image
+
+
+@contextmanager
+def openUVTTSource(source: Union[Path, bytes, BinaryIO]) -> Iterator[TextIO]:
+    '''Open Universal VTT data as text, from a file, from bytes, or from a binary stream
+
+    A stream given by the caller is left open afterwards.
+    '''
+    if isinstance(source, Path):
+        with source.open(mode='r') as f:
+            yield f
+        return
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    f = TextIOWrapper(source, encoding='utf-8')
+    try:
+        yield f
+    finally:
+        f.detach()
+
+
+jsonBackends = ['auto', 'orjson', 'json']
+
+
+def loadUVTTData(source: Union[Path, bytes, BinaryIO], backend: str = 'auto') -> dict:
+    '''Parse a whole Universal VTT file, with orjson if the backend allows and it is installed'''
+    if backend not in jsonBackends:
+        raise ValueError('Unknown JSON backend {}'.format(backend))
+
+    if backend != 'json' and not orjson:
+        if backend == 'orjson':
+            logging.warning('  orjson is not installed, using json')
+        backend = 'json'
+
+    if backend == 'json':
+        with openUVTTSource(source) as f:
+            return json.load(f)
+
+    if isinstance(source, Path):
+        with source.open(mode='rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return orjson.loads(b'')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                return orjson.loads(view)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return orjson.loads(source)
+    return orjson.loads(source.read())
+
+
+class UVTTStreamReader(object):
+    '''Incrementally parse the top level of a Universal VTT file, decoding or skipping the image in chunks'''
+    chunkSize = 1024 * 1024
+    whitespace = str.maketrans('', '', ' \t\r\n')
+
+    def __init__(self, f: TextIO, chunkSize: Optional[int] = None):
+        self.f = f
+        if chunkSize:
+            self.chunkSize = chunkSize
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self) -> bool:
+        '''Read more of the file into the buffer, False at the end of the file
+
+        The read size grows with the unconsumed part of the buffer so that
+        re-parsing a large value after each read stays linear overall.
+        '''
+        if self.eof:
+            return False
+
+        chunk = self.f.read(max(self.chunkSize, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        '''Skip over whitespace and return the next character'''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                raise ValueError('Unexpected end of file')
+
+    def expect(self, chars: str) -> str:
+        '''Consume the next character, which must be one of chars'''
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expected one of "{}" but found "{}"'.format(chars, c))
+        self.pos += 1
+        return c
+
+    def readValue(self):
+        '''Parse the complete JSON value at the current position'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+
+            # A number at the very end of the buffer may continue in the next read
+            if end == len(self.buf) and self.more():
+                continue
+
+            self.pos = end
+            return value
+
+    def readImage(self, sink: Optional[BinaryIO]) -> None:
+        '''Decode the base64 image string at the current position into sink
+
+        If sink is None the image is skipped without being decoded.
+        '''
+        self.expect('"')
+        pending = ''
+        while True:
+            end = self.buf.find('"', self.pos)
+            if end < 0:
+                text = self.buf[self.pos:]
+                # Keep a trailing backslash with the escape it starts
+                if text.endswith('\\'):
+                    text = text[:-1]
+                self.pos += len(text)
+            else:
+                text = self.buf[self.pos:end]
+                self.pos = end + 1
+
+            if sink is not None:
+                # base64 only ever needs escapes for '/' and line breaks
+                pending += text.replace('\\/', '/').replace('\\n', '').replace(
+                    '\\r', '').translate(self.whitespace)
+                usable = len(pending) - len(pending) % 4
+                if usable:
+                    sink.write(binascii.a2b_base64(pending[:usable]))
+                    pending = pending[usable:]
+
+            if end >= 0:
+                break
+            if not self.more():
+                raise ValueError('Unexpected end of file in image')
+
+        if pending:
+            raise ValueError('Truncated base64 image data')
+
+    def peekImage(self, size: int) -> bytes:
+        '''Decode up to size bytes from the start of the base64 image string at the current position
+
+        The image is left unconsumed, to be read or skipped afterwards.
+        '''
+        if self.peek() != '"':
+            return b''
+        # Leave room for escapes and line breaks within the first few characters
+        while len(self.buf) - self.pos < 4 * size and self.more():
+            pass
+        end = self.buf.find('"', self.pos + 1)
+        text = self.buf[self.pos + 1:end if end >= 0 else len(self.buf)]
+        text = text.replace('\\/', '/').replace('\\n', '').replace('\\r', '').translate(self.whitespace)
+        text = text[:(size + 2) // 3 * 4]
+        return binascii.a2b_base64(text[:len(text) - len(text) % 4])
+
+    def readHeader(self, imageBytes: int) -> Tuple[dict, bytes]:
+        '''Parse the file until its resolution and the first imageBytes bytes of its image have been read'''
+        data = {}
+        header = None
+
+        self.expect('{')
+        if self.peek() == '}':
+            return (data, b'')
+
+        while True:
+            key = self.readValue()
+            self.expect(':')
+            if key == 'image' and self.peek() == '"':
+                header = self.peekImage(imageBytes)
+                if 'resolution' in data:
+                    return (data, header)
+                self.readImage(None)
+            else:
+                data[key] = self.readValue()
+                if key == 'resolution' and header is not None:
+                    return (data, header)
+
+            if self.expect(',}') == '}':
+                return (data, header or b'')
+
+    def read(self, imageSink: Optional[BinaryIO] = None) -> dict:
+        '''Parse the whole file, returning every section except the image'''
+        data = {}
+
+        self.expect('{')
+        if self.peek() == '}':
+            return data
+
+        while True:
+            key = self.readValue()
+            self.expect(':')
+            if key == 'image' and self.peek() == '"':
+                self.readImage(imageSink)
+            else:
+                data[key] = self.readValue()
+
+            if self.expect(',}') == '}':
+                return data
+
+
+class XmlStreamWriter(object):
+    '''Write an XML document to a file an element at a time
+
+    The output is formatted the same way as minidom's toprettyxml() with a two
+    space indent, without holding the whole document in memory.
+    '''
+    indent = '  '
+
+    def __init__(self, f: TextIO) -> None:
+        self.f = f
+        self.stack = []
+        # Whether the most recently started element still needs its '>'
+        self.pending = False
+        self.f.write('<?xml version="1.0" ?>\n')
+
+    @staticmethod
+    def escape(text: str) -> str:
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '"', '&quot;').replace('>', '&gt;')
+
+    def openTag(self, tag: str, attrib: Optional[dict]) -> None:
+        '''Write the start of an element's opening tag, leaving it unterminated'''
+        self.closePending()
+        self.f.write('{}<{}'.format(self.indent * len(self.stack), tag))
+        for name, value in (attrib or {}).items():
+            self.f.write(' {}="{}"'.format(name, self.escape(value)))
+
+    def closePending(self) -> None:
+        if self.pending:
+            self.f.write('>\n')
+            self.pending = False
+
+    def start(self, tag: str, attrib: Optional[dict] = None) -> None:
+        '''Open an element whose children will be written next'''
+        self.openTag(tag, attrib)
+        self.stack.append(tag)
+        self.pending = True
+
+    def end(self) -> None:
+        '''Close the most recently started element'''
+        tag = self.stack.pop()
+        if self.pending:
+            self.f.write('/>\n')
+            self.pending = False
+        else:
+            self.f.write('{}</{}>\n'.format(self.indent * len(self.stack), tag))
+
+    def element(self, elem: ET.Element) -> None:
+        '''Write a complete element and its children'''
+        children = list(elem)
+        if not children:
+            self.openTag(elem.tag, elem.attrib)
+            if elem.text:
+                self.f.write('>{}</{}>\n'.format(self.escape(elem.text), elem.tag))
+            else:
+                self.f.write('/>\n')
+            return
+
+        self.start(elem.tag, elem.attrib)
+        if elem.text:
+            self.closePending()
+            self.f.write('{}{}\n'.format(self.indent * len(self.stack), self.escape(elem.text)))
+        for child in children:
+            self.element(child)
+        self.end()
+
+
 class UVTTFile(object):
+    rootAttrib = {'version': '4.1', 'dataversion': '20210302'}
+
     class Occluder(object):
-        '''Represents a generic Occluder'''
+        '''Represents a generic Occluder, with its points in a flat array of interleaved x and y coordinates'''
         def __init__(self):
-            self.points = []
+            self.coords = array('d')
+            # Flags the coordinates that were ints, written without a decimal point
+            self.intCoords = array('B')
 
         def xmlElemStart(self, id) -> ET.Element:
             '''Create the initial XML element for an occluder'''
@@ -146,9 +958,27 @@ class UVTTFile(object):
             elem.append(composeId(id))
             return elem
 
+        def xmlPointsElem(self) -> ET.Element:
+            '''Create the XML element for the points of an occluder'''
+            pointsElem = ET.Element('points')
+            ints = self.intCoords.count(1)
+            if not ints:
+                pointsElem.text = ','.join(map(str, self.coords))
+            elif ints == len(self.coords):
+                pointsElem.text = ','.join(map(str, map(int, self.coords)))
+            else:
+                pointsElem.text = ','.join([str(int(coord)) if isInt else str(coord)
+                                            for coord, isInt in zip(self.coords, self.intCoords)])
+            return pointsElem
+
         def addPoint(self, coord: Point):
             '''Add a point to this occluder'''
-            self.points.append(coord)
+            self.addCoords((coord.x, coord.y))
+
+        def addCoords(self, coords):
+            '''Add interleaved x and y coordinates to this occluder'''
+            self.coords.extend(coords)
+            self.intCoords.extend(map(isinstance, coords, repeat(int)))
 
     class WallOccluder(Occluder):
         '''Represents a Wall Occluder'''
@@ -156,14 +986,8 @@ class UVTTFile(object):
             '''Build up the XML representation of a wall'''
             elem = self.xmlElemStart(id)
 
-            logging.debug('  Occluder(Wall) {} {} points'.format(id, len(self.points)))
-            pointsElem = ET.Element('points')
-            pt = []
-            for point in self.points:
-                pt.append(str(point.x))
-                pt.append(str(point.y))
-            pointsElem.text = ','.join(pt)
-            elem.append(pointsElem)
+            logging.debug('  Occluder(Wall) {} {} points'.format(id, len(self.coords) // 2))
+            elem.append(self.xmlPointsElem())
 
             return elem
 
@@ -177,14 +1001,8 @@ class UVTTFile(object):
             '''Build up the XML representation of a wall'''
             elem = self.xmlElemStart(id)
 
-            logging.debug('  Occluder(Object) {} {} points'.format(id, len(self.points)))
-            pointsElem = ET.Element('points')
-            pt = []
-            for point in self.points:
-                pt.append(str(point.x))
-                pt.append(str(point.y))
-            pointsElem.text = ','.join(pt)
-            elem.append(pointsElem)
+            logging.debug('  Occluder(Object) {} {} points'.format(id, len(self.coords) // 2))
+            elem.append(self.xmlPointsElem())
 
             if self.objectsAreTerrain:
                 elem.append(ET.Element('terrain'))
@@ -207,19 +1025,14 @@ class UVTTFile(object):
 
         def addLine(self, point1, point2):
             '''Add a line to this portal'''
-            self.points.extend(convertLineToRect(
-                (point1, point2), self.widthAdj, self.lengthAdj, self.rotation))
+            for point in convertLineToRect(
+                    (point1, point2), self.widthAdj, self.lengthAdj, self.rotation):
+                self.addPoint(point)
 
         def xmlPoints(self, elem, id) -> None:
             '''Add the points data to the XML representation'''
-            logging.debug('  Occluder(Portal) {} {} points'.format(id, len(self.points)))
-            pointsElem = ET.Element('points')
-            pt = []
-            for point in self.points:
-                pt.append(str(point.x))
-                pt.append(str(point.y))
-            pointsElem.text = ','.join(pt)
-            elem.append(pointsElem)
+            logging.debug('  Occluder(Portal) {} {} points'.format(id, len(self.coords) // 2))
+            elem.append(self.xmlPointsElem())
 
             toggleAble = ET.Element('toggleable')
             elem.append(toggleAble)
@@ -256,10 +1069,30 @@ class UVTTFile(object):
 
             return elem
 
-    def __init__(self, filepath: Path, portalWidthAdjustment: str, portalLengthAdjustment: str, *args, **kwargs):
+    def __init__(self, filepath: Union[Path, bytes, BinaryIO], portalWidthAdjustment: str, portalLengthAdjustment: str, *args, streaming: bool = False, loadImage: bool = True, options: Optional[ConversionOptions] = None, stats: Optional['ConversionStats'] = None, **kwargs):
+        '''Load a Universal VTT file from a path, from bytes, or from a binary stream'''
         self.filepath = filepath
-        with self.filepath.open(mode='r') as f:
-            self.data = json.load(f)
+        self.options = options if options is not None else configData
+        self.stats = stats
+        if not loadImage:
+            # Only the geometry is wanted, skip over the image without decoding it
+            self.imageFile = None
+            with self.stage('json_load'), openUVTTSource(self.filepath) as f:
+                self.data = UVTTStreamReader(f).read()
+        elif streaming:
+            # Decode the image in chunks into an anonymous file, which lets the
+            # .png be copied by the kernel and Pillow read it for the .jpg
+            self.imageFile = tempfile.TemporaryFile()
+            with self.stage('stream_decode'), openUVTTSource(self.filepath) as f:
+                self.data = UVTTStreamReader(f).read(self.imageFile)
+        else:
+            with self.stage('json_load'):
+                self.data = loadUVTTData(self.filepath, self.options.jsonBackend)
+            with self.stage('base64_decode'):
+                self.imageFile = BytesIO(base64.decodebytes(self.data.pop('image').encode('utf-8')))
+
+        # Decoded images, keyed by mode, shared by all of the image encoders
+        self.decodedImages = {}
 
         mapsize = self.data['resolution']['map_size']
         self.originX = self.data['resolution']['map_origin']['x']
@@ -267,7 +1100,6 @@ class UVTTFile(object):
         logging.debug('  Origin: {},{}'.format(self.originX, self.originY))
         self.resolution = (mapsize['x'], mapsize['y'])
         self.gridsize = self.data['resolution']['pixels_per_grid']
-        self.image = base64.decodebytes(self.data['image'].encode('utf-8'))
         self.portalLengthAdjustmentPixels = translatePortalAdjustment(
             self.gridsize, portalLengthAdjustment)
         logging.debug('  Adding {} pixels to portal length'.format(
@@ -277,6 +1109,20 @@ class UVTTFile(object):
         logging.debug('  Adding {} pixels to portal width'.format(
             self.portalWidthAdjustmentPixels))
 
+        self.simplifyPixels = None
+        if self.options.simplify:
+            self.simplifyPixels = translateTolerance(self.gridsize, self.options.simplify)
+            logging.debug('  Simplifying walls to within {} pixels'.format(self.simplifyPixels))
+        self.portalAnchors = None
+        # Number of wall and object points before and after simplification
+        self.simplifyCounts = [0, 0]
+        # Number of walls before and after merging
+        self.mergeCounts = None
+
+    def stage(self, name: str):
+        '''Record a stage of the conversion, if statistics are being collected'''
+        return self.stats.stage(name) if self.stats is not None else nullcontext()
+
     def translateCoord(self, coord, dimension) -> float:
         '''Translate from a grid coordinate to a pixel coordinate'''
         return round(coord * self.gridsize + (dimension * self.gridsize) // 2, 1)
@@ -293,27 +1139,91 @@ class UVTTFile(object):
         '''Translate an x, y element from the uvtt data to a Point'''
         return Point(self.translateX(coord['x']), self.translateY(coord['y']))
 
+    # Below this many points the NumPy set up costs more than it saves
+    vectorMinPoints = 16
+
+    def translatePolyline(self, coords) -> list:
+        '''Translate a list of x, y elements from the uvtt data to interleaved pixel coordinates
+
+        When NumPy is available, longer lists are translated in one step with
+        exactly the same results as translateX and translateY.
+        '''
+        if not np or len(coords) < self.vectorMinPoints:
+            flat = []
+            for coord in coords:
+                flat.append(self.translateX(coord['x']))
+                flat.append(self.translateY(coord['y']))
+            return flat
+
+        flat = [None] * (2 * len(coords))
+        flat[0::2] = self.translateArray([coord['x'] for coord in coords], self.originX, -self.resolution[0], False)
+        flat[1::2] = self.translateArray([coord['y'] for coord in coords], self.originY, self.resolution[1], True)
+        return flat
+
+    def translateArray(self, values: list, origin, dimension, negate: bool) -> list:
+        '''Vectorized translateCoord for a list of grid coordinates along one axis'''
+        offset = (dimension * self.gridsize) // 2
+        coords = np.array(values, dtype=np.float64) - origin
+        if negate:
+            coords = -coords
+        pixels = coords * self.gridsize + offset
+
+        # Round to 1 decimal place.  This only differs from Python's correctly
+        # rounded round() when the value is within float error of a tie, so
+        # those few values are rounded again with round().
+        scaled = pixels * 10
+        rounded = np.rint(scaled) / 10
+        ties = np.flatnonzero((np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6) | (np.abs(pixels) >= 1e14))
+        result = rounded.tolist()
+        for i in ties.tolist():
+            result[i] = round(float(pixels[i]), 1)
+
+        # round() leaves whole numbers from int inputs as ints, which are
+        # formatted without a decimal point
+        if all(type(value) is int for value in (origin, dimension, self.gridsize)):
+            ints = np.fromiter(map(isinstance, values, repeat(int)), dtype=bool, count=len(values))
+            if ints.all():
+                return pixels.astype(np.int64).tolist()
+            for i in np.flatnonzero(ints).tolist():
+                result[i] = int(pixels[i])
+
+        return result
+
     def composeGrid(self) -> ET.Element:
         '''Build up the XML representation of the map's grid size'''
         elem = ET.Element('gridsize')
         elem.text = '{},{}'.format(self.gridsize, self.gridsize)
         return elem
 
+    def composePolyline(self, los) -> list:
+        '''Translate a line of sight polyline, simplifying it if configured to'''
+        coords = self.translatePolyline(los)
+        if self.simplifyPixels is None:
+            return coords
+
+        if self.portalAnchors is None:
+            # The ends of the portals, which the walls attach to
+            self.portalAnchors = set()
+            for portal in self.data['portals']:
+                it = iter(self.translatePolyline(portal['bounds']))
+                self.portalAnchors.update(zip(it, it))
+
+        simplified = simplifyPolyline(coords, self.simplifyPixels, self.portalAnchors)
+        self.simplifyCounts[0] += len(coords) // 2
+        self.simplifyCounts[1] += len(simplified) // 2
+        return simplified
+
     def composeWall(self, los) -> Occluder:
         '''Build up an Occluder representation of a wall'''
         wall = self.WallOccluder()
-
-        for coord in los:
-            wall.addPoint(self.translatePoint(coord))
+        wall.addCoords(self.composePolyline(los))
 
         return wall
 
     def composeObject(self, los) -> Occluder:
         '''Build up an Occluder representation of an object'''
-        object = self.ObjectOccluder(configData.objectsAreTerrain)
-
-        for coord in los:
-            object.addPoint(self.translatePoint(coord))
+        object = self.ObjectOccluder(self.options.objectsAreTerrain)
+        object.addCoords(self.composePolyline(los))
 
         return object
 
@@ -329,47 +1239,52 @@ class UVTTFile(object):
             portalElem = self.DoorOccluder(
                 portal['rotation'], self.portalWidthAdjustmentPixels, self.portalLengthAdjustmentPixels)
 
-        it = iter(portal['bounds'])
-        for point1, point2 in zip(it, it):
-            portalElem.addLine(self.translatePoint(point1),
-                               self.translatePoint(point2))
+        it = iter(self.translatePolyline(portal['bounds']))
+        for x1, y1, x2, y2 in zip(it, it, it, it):
+            portalElem.addLine(Point(x1, y1), Point(x2, y2))
 
         return portalElem
 
-    def composeOccluders(self) -> ET.Element:
-        '''Build up the XML representation of the line of sight elements'''
-        occluders = []
-
+    def iterOccluders(self):
+        '''Generate the Occluder representations of the line of sight elements, in id order'''
         # First the line-of-sight elements, AKA walls
         logging.debug('  {} los elements'.format(
             len(self.data['line_of_sight'])))
-        for los in self.data['line_of_sight']:
-            occluders.append(self.composeWall(los))
+        if self.options.mergeWalls:
+            walls = mergeWalls([self.composePolyline(los) for los in self.data['line_of_sight']])
+            self.mergeCounts = (len(self.data['line_of_sight']), len(walls))
+            for coords in walls:
+                wall = self.WallOccluder()
+                wall.addCoords(coords)
+                yield wall
+        else:
+            for los in self.data['line_of_sight']:
+                yield self.composeWall(los)
 
         objectsLoS = self.data.get('objects_line_of_sight', [])
 
         logging.debug('  {} object los elements'.format(len(objectsLoS)))
         for los in objectsLoS:
-            occluders.append(self.composeObject(los))
+            yield self.composeObject(los)
 
         # Next the portal elements, which may be doors or windows
         logging.debug('  {} portal elements'.format(len(self.data['portals'])))
         for portal in self.data['portals']:
-            occluders.append(self.composePortal(portal))
+            yield self.composePortal(portal)
 
+    def composeOccluders(self) -> ET.Element:
+        '''Build up the XML representation of the line of sight elements'''
         elem = ET.Element('occluders')
 
-        for id, occluder in enumerate(occluders):
+        for id, occluder in enumerate(self.iterOccluders()):
             elem.append(occluder.xmlElem(id))
 
         return elem
 
-    def composeLights(self) -> ET.Element:
-        '''Build up the XML representation of the lights'''
+    def iterLights(self):
+        '''Generate the XML representation of each light'''
         logging.debug('  {} lights'.format(len(self.data['lights'])))
 
-        elem = ET.Element('lights')
-
         for id, light in enumerate(self.data['lights']):
             lightElem = ET.Element('light')
 
@@ -392,71 +1307,1283 @@ class UVTTFile(object):
             on = ET.Element('on')
             lightElem.append(on)
 
+            yield lightElem
+
+    def composeLights(self) -> ET.Element:
+        '''Build up the XML representation of the lights'''
+        elem = ET.Element('lights')
+
+        for lightElem in self.iterLights():
             elem.append(lightElem)
 
         return elem
 
     def composeXml(self) -> ET.Element:
         '''Build up the FGU XML representation of the Universal VTT file'''
-        root = ET.Element(
-            'root', attrib={'version': '4.1', 'dataversion': '20210302'})
+        root = ET.Element('root', attrib=self.rootAttrib)
         root.append(self.composeGrid())
         root.append(self.composeOccluders())
         root.append(self.composeLights())
         return root
 
+    # Distance in grid squares that coordinates may be outside the map
+    boundsTolerance = 1e-6
+
+    def checkGeometry(self) -> Tuple[dict, List[str]]:
+        '''Check the geometry of the map, returning its occluder, point and light counts and any problems'''
+        problems = []
+        for section in ('line_of_sight', 'portals', 'lights'):
+            if section not in self.data:
+                problems.append('no {} section'.format(section))
+        if 'line_of_sight' in self.data and not self.data['line_of_sight']:
+            problems.append('line_of_sight is empty')
+
+        (left, top) = (self.originX - self.boundsTolerance, self.originY - self.boundsTolerance)
+        right = self.originX + self.resolution[0] + self.boundsTolerance
+        bottom = self.originY + self.resolution[1] + self.boundsTolerance
+        sections = {
+            'line_of_sight': [coord for los in self.data.get('line_of_sight', []) for coord in los],
+            'objects_line_of_sight': [coord for los in self.data.get('objects_line_of_sight', []) for coord in los],
+            'portals': [coord for portal in self.data.get('portals', []) for coord in portal['bounds'] + [portal['position']]],
+            'lights': [light['position'] for light in self.data.get('lights', [])],
+        }
+        for section, coords in sections.items():
+            outside = sum(1 for coord in coords if not (left <= coord['x'] <= right and top <= coord['y'] <= bottom))
+            if outside:
+                problems.append('{} points in {} are outside the map'.format(outside, section))
+
+        counts = {}
+        if not any(section not in self.data for section in ('line_of_sight', 'portals', 'lights')):
+            occluders = self.composeOccluders()
+            counts['occluders'] = len(occluders)
+            counts['points'] = sum(len(points.text.split(',')) // 2 for points in occluders.iter('points') if points.text)
+            counts['lights'] = len(self.composeLights())
+        return (counts, problems)
+
+    def decodeImage(self, mode: Optional[str] = None) -> Image.Image:
+        '''Decode the map image once for every encoder, optionally converted to mode'''
+        if None not in self.decodedImages:
+            with self.stage('decode_image'):
+                self.imageFile.seek(0)
+                image = Image.open(self.imageFile)
+                image.load()
+                self.decodedImages[None] = image
+
+        if mode not in self.decodedImages:
+            image = self.decodedImages[None]
+            if image.mode == mode:
+                self.decodedImages[mode] = image
+            else:
+                with self.stage('convert_image'):
+                    self.decodedImages[mode] = image.convert(mode)
+
+        return self.decodedImages[mode]
+
+    def close(self) -> None:
+        '''Release the image data'''
+        self.decodedImages.clear()
+        if self.imageFile:
+            self.imageFile.close()
+
     def writePng(self, filepath: Path) -> None:
         '''Write the image out as a .png file'''
         with filepath.open(mode='wb') as f:
-            f.write(self.image)
+            self.savePng(f)
+
+    def savePng(self, f: BinaryIO) -> None:
+        '''Write the .png image to a binary stream'''
+        copyImageFile(self.imageFile, f)
+
+    def encodeJpgToSize(self, maxBytes: int) -> Tuple[int, bytes, int]:
+        '''Binary search for the highest .jpg quality that fits in maxBytes, returning the quality, data and encodes'''
+        jpgimage = self.decodeImage('RGB')
+        attempts = 0
+
+        def encode(quality):
+            nonlocal attempts
+            attempts += 1
+            out = BytesIO()
+            jpgimage.save(
+                out,
+                format='JPEG',
+                quality=quality,
+                subsampling=self.options.jpgSubsampling,
+                optimize=self.options.jpgOptimize)
+            return out.getvalue()
+
+        data = encode(self.options.jpgQuality)
+        if len(data) <= maxBytes:
+            return (self.options.jpgQuality, data, attempts)
+
+        best = None
+        lowest = (self.options.jpgQuality, data)
+        (low, high) = (1, self.options.jpgQuality - 1)
+        while low <= high:
+            quality = (low + high) // 2
+            data = encode(quality)
+            if len(data) <= maxBytes:
+                best = (quality, data)
+                low = quality + 1
+            else:
+                lowest = min(lowest, (quality, data))
+                high = quality - 1
+
+        if best is None:
+            logging.warning('  Unable to fit the .jpg in {} bytes'.format(maxBytes))
+            best = lowest
+
+        return best + (attempts,)
 
     def writeJpg(self, filepath: Path) -> None:
         '''Write the image out as a .jpg file'''
-        imagebytes = BytesIO(self.image)
-        pngimage = Image.open(imagebytes)
-        jpgimage = pngimage.convert('RGB')
-        jpgimage.save(
-            filepath,
-            quality=configData.jpgQuality,
-            subsampling=configData.jpgSubsampling,
-            optimize=configData.jpgOptimize)
+        # Decode first, so that a corrupt image does not leave an empty file
+        self.decodeImage('RGB')
+        with filepath.open(mode='wb') as f:
+            self.saveJpg(f)
+
+    def saveJpg(self, f: BinaryIO) -> None:
+        '''Write the image to a binary stream as a .jpg
+
+        If a maximum size is configured, the quality is lowered as far as
+        needed to fit in it.
+        '''
+        if self.options.jpgMaxBytes:
+            (quality, data, attempts) = self.encodeJpgToSize(self.options.jpgMaxBytes)
+            logging.info('  Using .jpg quality {} ({} bytes) after {} encodes'.format(
+                quality, len(data), attempts))
+            f.write(data)
+            return
+
+        self.saveJpgImage(self.decodeImage('RGB'), f)
+
+    def saveJpgImage(self, image: Image.Image, f: BinaryIO) -> None:
+        '''Write an image to a binary stream as a .jpg with the configured settings'''
+        image.save(
+            f,
+            format='JPEG',
+            quality=self.options.jpgQuality,
+            subsampling=self.options.jpgSubsampling,
+            optimize=self.options.jpgOptimize)
+
+    def iterImageBands(self, rows: int):
+        '''Generate (top, image) for each band of up to rows rows of the map image
+
+        Only one band is decoded at a time, unless the whole image has already
+        been decoded for another output or cannot be decoded in bands.
+        '''
+        if None not in self.decodedImages:
+            self.imageFile.seek(0)
+            try:
+                reader = PngBandReader(self.imageFile)
+            except ValueError:
+                reader = None
+            if reader and reader.supported:
+                yield from reader.bands(rows)
+                return
+            logging.debug('  Image cannot be decoded in bands, decoding all of it')
+
+        image = self.decodeImage()
+        for top in range(0, image.height, rows):
+            yield (top, image.crop((0, top, image.width, min(top + rows, image.height))))
+
+    def writeTiles(self, directory: Path, tileSize: int, levels: int) -> None:
+        '''Write the image out as a pyramid of .jpg tiles, each level half the size of the one before'''
+        if tileSize % (2 ** levels):
+            raise ValueError('Tile size {} is not divisible by {}'.format(tileSize, 2 ** levels))
+
+        manifest = {'tilesize': tileSize, 'format': 'jpg', 'levels': []}
+        strips = []
+        for level in range(levels + 1):
+            (directory / str(level)).mkdir(parents=True, exist_ok=True)
+            strips.append({'image': None, 'filled': 0, 'row': 0})
+
+        def flush(level, strip):
+            image = strip['image'].crop((0, 0, strip['image'].width, strip['filled']))
+            for column, left in enumerate(range(0, image.width, tileSize)):
+                tile = image.crop((left, 0, min(left + tileSize, image.width), image.height))
+                tile.save(
+                    directory / str(level) / '{}_{}.jpg'.format(strip['row'], column),
+                    quality=self.options.jpgQuality,
+                    subsampling=self.options.jpgSubsampling,
+                    optimize=self.options.jpgOptimize)
+            strip.update(image=None, filled=0, row=strip['row'] + 1)
+
+        (width, height) = (0, 0)
+        for (top, band) in self.iterImageBands(tileSize):
+            band = band.convert('RGB')
+            (width, height) = (band.width, top + band.height)
+            for level, strip in enumerate(strips):
+                reduced = band.reduce(2 ** level) if level else band
+                if strip['image'] is None:
+                    strip['image'] = Image.new('RGB', (reduced.width, tileSize))
+                strip['image'].paste(reduced, (0, strip['filled']))
+                strip['filled'] += reduced.height
+                if strip['filled'] >= tileSize:
+                    flush(level, strip)
+
+        for level, strip in enumerate(strips):
+            if strip['image'] is not None:
+                flush(level, strip)
+            scale = 2 ** level
+            manifest['levels'].append({
+                'level': level,
+                'width': -(-width // scale),
+                'height': -(-height // scale),
+                'columns': -(-width // (tileSize * scale)),
+                'rows': strip['row'],
+            })
+
+        manifest['width'] = width
+        manifest['height'] = height
+        with (directory / 'tiles.json').open('w') as f:
+            json.dump(manifest, f, indent=1)
+
+    def makeThumbnail(self, size: Tuple[int, int]) -> Image.Image:
+        '''Shrink the map image to fit within size, keeping its shape'''
+        self.imageFile.seek(0)
+        with Image.open(self.imageFile) as image:
+            (width, height) = image.size
+        # Reduce by the largest whole factor with a box filter, then resize the rest of the way
+        factor = max(1, min(width // size[0], height // size[1]))
+
+        decoded = self.decodedImages.get(None)
+        if 'RGB' in self.decodedImages or (decoded is not None and decoded.mode == 'RGB'):
+            image = self.decodeImage('RGB')
+            reduced = image.reduce(factor) if factor > 1 else image.copy()
+        else:
+            # A band at a time, from the decoded image if there is one, so
+            # that only a band is ever converted to RGB
+            reduced = Image.new('RGB', (-(-width // factor), -(-height // factor)))
+            for (top, band) in self.iterImageBands(factor * max(1, 256 // factor)):
+                band = band.convert('RGB')
+                reduced.paste(band.reduce(factor) if factor > 1 else band, (0, top // factor))
+
+        reduced.thumbnail(size)
+        return reduced
+
+    def writeThumbnail(self, filepath: Path) -> None:
+        '''Write a thumbnail of the image out as a .jpg file'''
+        thumbnail = self.makeThumbnail(self.options.thumbnailSize)
+        with filepath.open(mode='wb') as f:
+            self.saveJpgImage(thumbnail, f)
+
+    def saveThumbnail(self, f: BinaryIO) -> None:
+        '''Write a thumbnail of the image to a binary stream as a .jpg'''
+        self.saveJpgImage(self.makeThumbnail(self.options.thumbnailSize), f)
+
+    def writeEncoded(self, encoder: ImageEncoder, filepath: Union[Path, BinaryIO]) -> None:
+        '''Write the image out with one of the additional image encoders, to a file or a binary stream'''
+        image = self.decodeImage()
+        encoder.save(self.decodeImage(encoder.imageMode(image)), filepath)
 
     def writeXml(self, filepath: Path) -> None:
         '''Write out the FGU .xml file for line-of-sight and lighting'''
-        xmlTree = self.composeXml()
-        xmlStr = minidom.parseString(
-            ET.tostring(xmlTree)).toprettyxml(indent="  ")
         with filepath.open('w') as f:
-            f.write(xmlStr)
+            self.saveXml(f)
+
+    def saveXmlBinary(self, f: BinaryIO) -> None:
+        '''Write the FGU .xml to a binary stream, encoded as UTF-8'''
+        text = TextIOWrapper(f, encoding='utf-8')
+        self.saveXml(text)
+        text.flush()
+        text.detach()
+
+    def saveXml(self, f: TextIO) -> None:
+        '''Write the FGU .xml to a text stream
+
+        Each occluder and light is written as soon as it is built, rather than
+        building the whole document first.
+        '''
+        writer = XmlStreamWriter(f)
+        writer.start('root', self.rootAttrib)
+        writer.element(self.composeGrid())
+
+        writer.start('occluders')
+        for id, occluder in enumerate(self.iterOccluders()):
+            writer.element(occluder.xmlElem(id))
+        writer.end()
 
+        writer.start('lights')
+        for lightElem in self.iterLights():
+            writer.element(lightElem)
+        writer.end()
 
-def processFile(filepaths: Tuple[Path, Path, Path, Path], portalWidthAdjustment: str, portalLengthAdjustment: str) -> None:
-    '''Process an individual Universal VTT file'''
+        writer.end()
+
+
+class ConversionResult(object):
+    '''The outputs of convert() as bytes, None for those not written or written to a stream'''
+
+    def __init__(self, resolution: Tuple[int, int], gridsize: int) -> None:
+        self.resolution = resolution
+        self.gridsize = gridsize
+        self.xml = None
+        self.png = None
+        self.jpg = None
+        self.thumbnail = None
+        self.images = {}
+
+
+def convert(source: Union[bytes, BinaryIO], options: Optional[ConversionOptions] = None, xml: Optional[BinaryIO] = None, png: Optional[BinaryIO] = None, jpg: Optional[BinaryIO] = None) -> ConversionResult:
+    '''Convert a Universal VTT map held in memory or read from a binary stream
+
+    Each output is written to the stream given for it, otherwise it is
+    returned as bytes.
+    '''
+    if options is None:
+        options = ConversionOptions()
+
+    uvttfile = UVTTFile(source, options.portalWidth, options.portalLength,
+                        streaming=options.streaming, options=options)
+    result = ConversionResult(uvttfile.resolution, uvttfile.gridsize)
+
+    def output(stream, write):
+        if stream is not None:
+            write(stream)
+            return None
+        out = BytesIO()
+        write(out)
+        return out.getvalue()
+
+    try:
+        if options.writepng:
+            result.png = output(png, uvttfile.savePng)
+        if options.writejpg:
+            result.jpg = output(jpg, uvttfile.saveJpg)
+        for encoder in options.encoders:
+            result.images[encoder.name] = output(None, lambda f: uvttfile.writeEncoded(encoder, f))
+        if options.thumbnailSize:
+            result.thumbnail = output(None, uvttfile.saveThumbnail)
+        result.xml = output(xml, uvttfile.saveXmlBinary)
+    finally:
+        uvttfile.close()
+
+    return result
+
+
+def convertPath(filepath: Union[str, Path], options: Optional[ConversionOptions] = None) -> ConversionResult:
+    '''Read a Universal VTT file and convert it with convert()'''
+    with open(filepath, 'rb') as f:
+        return convert(f, options)
+
+
+async def convertMany(filepaths: Iterable[Union[str, Path]], options: Optional[ConversionOptions] = None, concurrency: int = 4, executor=None) -> AsyncIterator[Tuple[Union[str, Path], Optional[ConversionResult]]]:
+    '''Convert Universal VTT files from an asyncio event loop, yielding (filepath, result) as each one finishes
+
+    A file that fails to convert is logged and yielded with a result of None.
+    '''
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+    loop = asyncio.get_running_loop()
+    running = {}
+
+    def finished(done):
+        for task in done:
+            filepath = running.pop(task)
+            try:
+                yield (filepath, task.result())
+            except Exception as e:
+                logging.error('{}: {}, skipping'.format(filepath, e))
+                yield (filepath, None)
+
+    try:
+        for filepath in filepaths:
+            if len(running) >= concurrency:
+                (done, _) = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for item in finished(done):
+                    yield item
+            task = loop.run_in_executor(executor, convertPath, filepath, options)
+            running[task] = filepath
+
+        while running:
+            (done, _) = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for item in finished(done):
+                yield item
+    finally:
+        for task in running:
+            task.cancel()
+
+
+def writeImage(filepath: Path, write) -> None:
+    '''Write one output file, logging how long it took and how big it is'''
+    logging.info('  Writing {}'.format(filepath))
+    start = time.perf_counter()
+    write(filepath)
+    logging.info('    {} bytes in {:.2f}s'.format(filepath.stat().st_size, time.perf_counter() - start))
+
+
+def processFile(filepaths: Tuple[Path, Path, Path, Path], portalWidthAdjustment: str, portalLengthAdjustment: str, writeImages: bool = True, stats: Optional['ConversionStats'] = None, module: Optional['ModuleEntryCollector'] = None) -> None:
+    '''Process an individual Universal VTT file, only writing the .xml unless writeImages is set'''
     (uvttpath, pngpath, jpgpath, xmlpath) = filepaths
 
+    def stage(name, output=None):
+        return stats.stage(name, output) if stats is not None else nullcontext()
+
+    def output(name, filepath, write, save, compress=False):
+        if module is not None:
+            with stage(name):
+                module.writeEntry(filepath, save, compress)
+        else:
+            with stage(name, filepath):
+                writeImage(filepath, write)
+
     logging.info('Processing {}'.format(uvttpath))
-    uvttfile = UVTTFile(uvttpath, portalWidthAdjustment,
-                        portalLengthAdjustment)
+    with stats.file(uvttpath) if stats is not None else nullcontext():
+        uvttfile = UVTTFile(uvttpath, portalWidthAdjustment, portalLengthAdjustment,
+                            streaming=configData.streaming, loadImage=writeImages, stats=stats)
+
+        logging.debug('  Map dimensions: {} grid elements'.format(
+            uvttfile.resolution))
+        logging.debug('  Grid Size: {} pixels'.format(uvttfile.gridsize))
+
+        if not writeImages:
+            logging.info('  Images are up to date')
+
+        if configData.writepng and writeImages:
+            output('write_png', pngpath, uvttfile.writePng, uvttfile.savePng)
+
+        # Before anything decodes the whole image, so that the tiles are
+        # decoded a band at a time
+        if configData.tileSize and writeImages:
+            tilepath = composeTilePath(uvttpath)
+            logging.info('  Writing {}'.format(tilepath))
+            with stage('write_tiles', tilepath):
+                uvttfile.writeTiles(tilepath, configData.tileSize, configData.tileLevels)
 
-    logging.debug('  Map dimensions: {} grid elements'.format(
-        uvttfile.resolution))
-    logging.debug('  Grid Size: {} pixels'.format(uvttfile.gridsize))
+        if configData.writejpg and writeImages:
+            output('write_jpg', jpgpath, uvttfile.writeJpg, uvttfile.saveJpg)
 
-    if configData.writepng:
-        logging.info('  Writing {}'.format(pngpath))
-        uvttfile.writePng(pngpath)
+        for encoder in configData.encoders if writeImages else []:
+            save = lambda f: uvttfile.writeEncoded(encoder, f)
+            output('write_' + encoder.name, composeEncoderPath(encoder, uvttpath), save, save)
 
-    if configData.writejpg:
-        logging.info('  Writing {}'.format(jpgpath))
-        uvttfile.writeJpg(jpgpath)
+        if configData.thumbnailSize and writeImages:
+            output('write_thumbnail', composeThumbnailPath(uvttpath), uvttfile.writeThumbnail,
+                   uvttfile.saveThumbnail)
 
-    logging.info('  Writing {}'.format(xmlpath))
-    uvttfile.writeXml(xmlpath)
+        output('write_xml', xmlpath, uvttfile.writeXml, uvttfile.saveXmlBinary, compress=True)
+
+        if uvttfile.simplifyPixels is not None:
+            logging.info('  Simplified walls from {} to {} points'.format(*uvttfile.simplifyCounts))
+        if uvttfile.mergeCounts is not None:
+            logging.info('  Merged {} walls into {}'.format(*uvttfile.mergeCounts))
+
+        uvttfile.close()
 
     if configData.remove:
         remove(uvttpath)
 
 
+class ConversionStats(object):
+    '''The wall time, CPU time, peak traced memory and bytes written of each stage of each conversion'''
+
+    def __init__(self, jsonLinesPath: Optional[Path] = None) -> None:
+        self.records = []
+        self.jsonLinesPath = jsonLinesPath
+        self.filepath = None
+        self.stack = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @staticmethod
+    def outputSize(output: Optional[Path]) -> Optional[int]:
+        '''The size of an output file, or of all the files in an output directory'''
+        if output is None or not output.exists():
+            return None
+        if output.is_dir():
+            return sum(f.stat().st_size for f in output.rglob('*') if f.is_file())
+        return output.stat().st_size
+
+    @contextmanager
+    def file(self, filepath: Path) -> Iterator[None]:
+        '''Record the stages of converting one file'''
+        self.filepath = filepath
+        try:
+            with self.stage('total'):
+                yield
+        finally:
+            self.filepath = None
+
+    @contextmanager
+    def stage(self, name: str, output: Optional[Path] = None) -> Iterator[None]:
+        '''Record one stage of the current file, output being the file or directory it writes'''
+        (current, peak) = tracemalloc.get_traced_memory()
+        if self.stack:
+            # The peak is reset for this stage, so keep the enclosing stage's so far
+            self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'start': current, 'peak': current}
+        self.stack.append(frame)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            self.stack.pop()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], frame['peak'])
+
+        self.add([{
+            'file': str(self.filepath),
+            'stage': name,
+            'wall': round(wall, 6),
+            'cpu': round(cpu, 6),
+            'peak': frame['peak'] - frame['start'],
+            'bytes': self.outputSize(output),
+        }])
+
+    def add(self, records: List[dict]) -> None:
+        '''Add records, such as those collected in a worker process'''
+        self.records.extend(records)
+        if self.jsonLinesPath and records:
+            with self.jsonLinesPath.open('a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+
+    def summary(self) -> List[str]:
+        '''A table of each stage, totalled over all of the files'''
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record['stage'], {'files': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': 0, 'bytes': 0})
+            total['files'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            total['peak'] = max(total['peak'], record['peak'])
+            total['bytes'] += record['bytes'] or 0
+        if 'total' in stages:
+            stages['total'] = stages.pop('total')
+
+        lines = ['{:<16} {:>6} {:>10} {:>10} {:>12} {:>14}'.format(
+            'Stage', 'Files', 'Wall (s)', 'CPU (s)', 'Peak memory', 'Bytes written')]
+        for name, total in stages.items():
+            lines.append('{:<16} {:>6} {:>10.3f} {:>10.3f} {:>12} {:>14}'.format(
+                name, total['files'], total['wall'], total['cpu'], total['peak'], total['bytes']))
+        return lines
+
+
+class ModuleWriter(object):
+    '''Writes the converted maps under images/ in a Fantasy Grounds module archive'''
+    folder = 'images'
+
+    def __init__(self, filepath: Path) -> None:
+        self.filepath = filepath
+        self.zip = zipfile.ZipFile(filepath, 'w')
+        # Each map's outputs are spooled here until the whole map has converted
+        self.spoolDirectory = Path(tempfile.mkdtemp(prefix='.{}-'.format(filepath.name), dir=filepath.parent))
+
+    @classmethod
+    def entryName(cls, filepath: Path) -> str:
+        '''The name in the archive of an output file'''
+        return '{}/{}'.format(cls.folder, filepath.name)
+
+    @staticmethod
+    def entryInfo(name: str, compress: bool) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        return info
+
+    def addEntries(self, entries: List[Tuple[str, Path, bool]]) -> None:
+        '''Copy the entries spooled while converting a map into the archive'''
+        for (name, spoolpath, compress) in entries:
+            info = self.entryInfo(name, compress)
+            # Knowing the size lets zipfile use zip64 for entries too big for a plain zip
+            info.file_size = spoolpath.stat().st_size
+            with spoolpath.open('rb') as src, self.zip.open(info, 'w') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            spoolpath.unlink()
+
+    def close(self) -> None:
+        self.zip.close()
+        shutil.rmtree(self.spoolDirectory, ignore_errors=True)
+
+
+class ModuleEntryCollector(object):
+    '''Spools a map's module entries to temporary files, to be added to the archive only if the whole map converts'''
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.entries = []
+
+    def writeEntry(self, filepath: Path, save, compress: bool) -> None:
+        name = ModuleWriter.entryName(filepath)
+        logging.info('  Writing {}'.format(name))
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            self.entries.append((name, Path(f.name), compress))
+            save(f)
+
+    def discard(self) -> None:
+        '''Remove the spooled entries of a map that failed'''
+        for (_, spoolpath, _) in self.entries:
+            spoolpath.unlink()
+        self.entries.clear()
+
+
+class LogRecordCollector(logging.Handler):
+    '''Logging handler that keeps the records so they can be replayed later'''
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Flatten the message so the record can be pickled back to the parent
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def initWorker(config: ConfigFileData, logLevel: int) -> None:
+    '''Set up a worker process of the conversion pool
+
+    The worker's log output is collected per file and handed back to the
+    parent process, so any inherited handlers are removed.  Ctrl-C reaches
+    the whole process group, so it is ignored here and left to the parent,
+    which lets the maps already being converted finish.
+    '''
+    global configData
+    configData = config
+    applyImageLimits()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(logLevel)
+
+
+def processFileSafe(filepaths: Tuple[Path, Path, Path, Path], portalWidthAdjustment: str, portalLengthAdjustment: str, writeImages: bool = True, stats: Optional[ConversionStats] = None, module: Optional[ModuleEntryCollector] = None) -> int:
+    '''Process an individual Universal VTT file, turning any failure into an exit code'''
+    try:
+        processFile(filepaths, portalWidthAdjustment, portalLengthAdjustment, writeImages, stats, module)
+    except Exception as e:
+        logging.error('{}: {}, skipping'.format(filepaths[0], e))
+        return getattr(e, 'errno', None) or errno.EIO
+
+    return 0
+
+
+def processFileJob(filepaths: Tuple[Path, Path, Path, Path], portalWidthAdjustment: str, portalLengthAdjustment: str, writeImages: bool = True, profile: bool = False, module: Optional[Path] = None) -> Tuple[int, List[logging.LogRecord], List[dict], List[Tuple[str, Path, bool]]]:
+    '''Process an individual Universal VTT file in a worker process
+
+    Returns the exit code, log records, stage statistics and the module
+    entries spooled into the module directory, if one is given.
+    '''
+    collector = LogRecordCollector()
+    logger = logging.getLogger()
+    logger.addHandler(collector)
+    stats = ConversionStats() if profile else None
+    entries = ModuleEntryCollector(module) if module else None
+    try:
+        exitcode = processFileSafe(filepaths, portalWidthAdjustment, portalLengthAdjustment, writeImages, stats,
+                                   entries)
+    finally:
+        logger.removeHandler(collector)
+
+    if exitcode and entries:
+        # A file that failed part way through leaves nothing in the module
+        entries.discard()
+    return (exitcode, collector.records, stats.records if stats else [], entries.entries if entries else [])
+
+
+def estimateMemory(filepath: Path, writeImages: bool = True) -> int:
+    '''Estimate the memory in bytes needed to convert a file, from its image header without decoding it'''
+    signature = PngBandReader.signature
+    with openUVTTSource(filepath) as f:
+        # The signature, then the length, type and contents of the IHDR chunk
+        (data, header) = UVTTStreamReader(f).readHeader(len(signature) + 8 + 13)
+
+    if header[:len(signature)] == signature and header[12:16] == b'IHDR':
+        (width, height, _, colorType) = struct.unpack('>IIBB', header[16:26])
+    else:
+        resolution = data.get('resolution', {})
+        gridsize = resolution.get('pixels_per_grid', 0)
+        mapSize = resolution.get('map_size', {})
+        (width, height) = (mapSize.get('x', 0) * gridsize, mapSize.get('y', 0) * gridsize)
+        colorType = None
+
+    # Unless streaming, the file is held in memory while it is parsed and its
+    # image decoded from base64
+    estimate = 0 if configData.streaming else 2 * filepath.stat().st_size
+    # Pillow holds a decoded image at up to four bytes a pixel, and the .jpg
+    # and other encoders need an RGB copy unless the PNG is already RGB
+    if writeImages and (configData.writejpg or configData.encoders):
+        pixels = int(width * height)
+        estimate += 4 * pixels
+        if colorType != 2:
+            estimate += 4 * pixels
+    return estimate
+
+
+class MemoryScheduler(object):
+    '''Chooses which files to start converting, largest first, keeping their combined memory estimate within a budget'''
+
+    def __init__(self, estimates: List[int], budget: int, workers: int) -> None:
+        self.estimates = estimates
+        self.budget = budget
+        self.workers = workers
+        self.waiting = sorted(range(len(estimates)), key=lambda index: -estimates[index])
+        self.running = set()
+        self.used = 0
+
+    def start(self) -> List[int]:
+        '''Return the indexes of the files that can be started now'''
+        started = []
+        for index in list(self.waiting):
+            if len(self.running) >= self.workers:
+                break
+            if self.running and self.used + self.estimates[index] > self.budget:
+                continue
+            self.waiting.remove(index)
+            self.running.add(index)
+            self.used += self.estimates[index]
+            started.append(index)
+        return started
+
+    def finished(self, index: int) -> None:
+        '''Release the memory of a file that has been converted'''
+        self.running.remove(index)
+        self.used -= self.estimates[index]
+
+
+@contextmanager
+def cancelOnInterrupt() -> Iterator[List['concurrentFutures.Future']]:
+    '''Collect submitted futures, cancelling those not yet started if interrupted
+
+    The workers ignore Ctrl-C, so the maps already being converted finish
+    while the pool shuts down, and only the ones still waiting are dropped.
+    '''
+    futures = []
+    try:
+        yield futures
+    except KeyboardInterrupt:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def processFiles(jobs: List[Tuple[Path, Path, Path, Path]], portalWidthAdjustment: str, portalLengthAdjustment: str, cache: Optional['ConversionCache'] = None, stats: Optional[ConversionStats] = None, module: Optional[ModuleWriter] = None) -> int:
+    '''Process a batch of Universal VTT files, in parallel if configured to, reporting each in the order given'''
+    exitcode = 0
+
+    def writeImages(filepaths):
+        return not (cache and cache.imagesUpToDate(filepaths))
+
+    workers = configData.jobs if configData.jobs > 0 else None
+    if workers == 1 or len(jobs) <= 1:
+        for filepaths in jobs:
+            entries = ModuleEntryCollector(module.spoolDirectory) if module else None
+            fileexitcode = processFileSafe(filepaths, portalWidthAdjustment, portalLengthAdjustment,
+                                           writeImages(filepaths), stats, entries)
+            if module and fileexitcode:
+                entries.discard()
+            elif module:
+                module.addEntries(entries.entries)
+            if cache:
+                cache.update(filepaths, fileexitcode)
+            exitcode = fileexitcode or exitcode
+        return exitcode
+
+    logger = logging.getLogger()
+    workers = workers or os.cpu_count()
+
+    def complete(filepaths, future):
+        '''Record a finished file, returning its exit code and the log records still to be reported'''
+        try:
+            (fileexitcode, records, statsRecords, entries) = future.result()
+        except (Exception, KeyboardInterrupt) as e:
+            fileexitcode = errno.EIO
+            records = [logger.makeRecord(logger.name, logging.ERROR, __file__, 0,
+                                         '{}: {}, skipping'.format(filepaths[0], e), None, None)]
+            (statsRecords, entries) = ([], [])
+
+        if stats:
+            stats.add(statsRecords)
+        if module:
+            module.addEntries(entries)
+        if cache:
+            cache.update(filepaths, fileexitcode)
+        return (fileexitcode, records)
+
+    def report(fileexitcode, records):
+        for record in records:
+            logger.handle(record)
+        return fileexitcode
+
+    with concurrentFutures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                                               initargs=(configData, logger.getEffectiveLevel())) as executor, \
+            cancelOnInterrupt() as submitted:
+        def submit(filepaths):
+            future = executor.submit(processFileJob, filepaths, portalWidthAdjustment, portalLengthAdjustment,
+                                     writeImages(filepaths), stats is not None,
+                                     module.spoolDirectory if module else None)
+            submitted.append(future)
+            return future
+
+        if configData.maxMemory:
+            estimates = []
+            for filepaths in jobs:
+                try:
+                    estimate = estimateMemory(filepaths[0], writeImages(filepaths))
+                except (OSError, ValueError) as e:
+                    # The conversion itself will report the problem
+                    logging.debug('{}: cannot estimate memory: {}'.format(filepaths[0], e))
+                    estimate = 0
+                if estimate > configData.maxMemory:
+                    logging.warning('{}: needs about {} MB, more than --max-memory, so it will be converted on its own'.format(
+                        filepaths[0], estimate // 1024 ** 2))
+                estimates.append(estimate)
+
+            # Files are started in order of size, and their outputs written as
+            # soon as they finish, but their log output is reported in the
+            # order they were given
+            scheduler = MemoryScheduler(estimates, configData.maxMemory, workers)
+            running = {}
+            finished = {}
+            nextIndex = 0
+            while nextIndex < len(jobs):
+                for index in scheduler.start():
+                    running[submit(jobs[index])] = index
+                (done, _) = concurrentFutures.wait(running, return_when=concurrentFutures.FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    scheduler.finished(index)
+                    finished[index] = complete(jobs[index], future)
+                while nextIndex in finished:
+                    exitcode = report(*finished.pop(nextIndex)) or exitcode
+                    nextIndex += 1
+            return exitcode
+
+        # Only keep a few files ahead of the one being reported, so that the
+        # results waiting their turn do not pile up in memory
+        pending = deque()
+        jobs = iter(jobs)
+        while True:
+            for filepaths in jobs:
+                pending.append((filepaths, submit(filepaths)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+
+            (filepaths, future) = pending.popleft()
+            exitcode = report(*complete(filepaths, future)) or exitcode
+
+    return exitcode
+
+
+class WatchFolder(object):
+    '''Tracks the .dd2vtt files in a directory, reporting each export once it has been completely written'''
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.seen = {}
+        self.reported = {}
+
+    @staticmethod
+    def isComplete(filepath: Path) -> bool:
+        '''Check that the file ends with the end of a JSON object'''
+        try:
+            with filepath.open('rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - 64, 0))
+                return f.read().rstrip().endswith(b'}')
+        except OSError:
+            return False
+
+    def poll(self) -> List[Path]:
+        '''The files that have been completely written since the last poll'''
+        ready = []
+        current = {}
+        with os.scandir(self.directory) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if not entry.name.endswith('.dd2vtt'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                filepath = Path(entry.path)
+                state = (stat.st_size, stat.st_mtime_ns)
+                current[filepath] = state
+                if self.seen.get(filepath) != state or self.reported.get(filepath) == state:
+                    continue
+                if not self.isComplete(filepath):
+                    continue
+
+                self.reported[filepath] = state
+                ready.append(filepath)
+
+        self.seen = current
+        self.reported = {filepath: state for filepath, state in self.reported.items() if filepath in current}
+        return ready
+
+
+def watchFolder(directory: Path, portalWidthAdjustment: str, portalLengthAdjustment: str, cache: Optional['ConversionCache'] = None, polls: Optional[int] = None, stats: Optional[ConversionStats] = None) -> int:
+    '''Convert .dd2vtt files as they are exported into a directory, until interrupted or for the given number of polls'''
+    exitcode = 0
+    watcher = WatchFolder(directory)
+    pending = deque()
+    running = {}
+    logger = logging.getLogger()
+
+    workers = configData.jobs if configData.jobs > 0 else os.cpu_count()
+    executor = None
+    if workers > 1:
+        executor = concurrentFutures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                                                         initargs=(configData, logger.getEffectiveLevel()))
+
+    def finished(filepaths, fileexitcode):
+        nonlocal exitcode
+        if cache:
+            cache.update(filepaths, fileexitcode)
+            cache.save()
+        exitcode = fileexitcode or exitcode
+
+    def collect(futures):
+        for future in futures:
+            filepaths = running.pop(future)
+            try:
+                (fileexitcode, records, statsRecords, _) = future.result()
+            except (Exception, KeyboardInterrupt) as e:
+                logging.error('{}: {}, skipping'.format(filepaths[0], e))
+                fileexitcode = errno.EIO
+                (records, statsRecords) = ([], [])
+
+            for record in records:
+                logger.handle(record)
+            if stats:
+                stats.add(statsRecords)
+            finished(filepaths, fileexitcode)
+
+    logging.info('Watching {} for .dd2vtt files'.format(directory))
+    converting = None
+    try:
+        while polls is None or polls > 0:
+            if polls is not None:
+                polls -= 1
+
+            for filepath in watcher.poll():
+                filepaths = composeFilePaths(filepath)
+                if cache and cache.isUpToDate(filepaths):
+                    logging.info('{}: outputs are up to date, skipping'.format(filepaths[0]))
+                    continue
+                existing = existingOutputs(filepaths, cache)
+                for output in existing:
+                    logging.error('{}: file already exists, skipping'.format(output))
+                if existing:
+                    exitcode = errno.EEXIST
+                    continue
+                pending.append(filepaths)
+
+            while pending and len(running) < workers:
+                filepaths = pending.popleft()
+                writeImages = not (cache and cache.imagesUpToDate(filepaths))
+                if executor is None:
+                    converting = (filepaths, outputStates(filepaths))
+                    fileexitcode = processFileSafe(filepaths, portalWidthAdjustment, portalLengthAdjustment,
+                                                   writeImages, stats)
+                    converting = None
+                    finished(filepaths, fileexitcode)
+                else:
+                    future = executor.submit(processFileJob, filepaths, portalWidthAdjustment,
+                                             portalLengthAdjustment, writeImages, stats is not None)
+                    running[future] = filepaths
+
+            if running:
+                (done, _) = concurrentFutures.wait(running, timeout=configData.watchInterval,
+                                                   return_when=concurrentFutures.FIRST_COMPLETED)
+                collect(done)
+            elif polls is None or polls > 0:
+                time.sleep(configData.watchInterval)
+    except KeyboardInterrupt:
+        logging.info('Stopped watching {}'.format(directory))
+        if converting:
+            # Interrupted part way through a map in this process, so remove
+            # what it wrote rather than leave it to block the next run
+            removePartialOutputs(*converting)
+        # The workers ignore Ctrl-C, so wait for the maps they have started
+        # and drop the rest
+        for future in list(running):
+            if future.cancel():
+                del running[future]
+        if running:
+            logging.info('Waiting for the maps being converted to finish')
+    finally:
+        if executor is not None:
+            collect(list(running))
+            executor.shutdown()
+
+    return exitcode
+
+
+def outputStates(filepaths: Tuple[Path, Path, Path, Path]) -> dict:
+    '''The size and modification time of each output that exists, to tell later which ones a conversion wrote'''
+    states = {}
+    for filepath in composeOutputPaths(filepaths):
+        try:
+            stat = filepath.stat()
+        except FileNotFoundError:
+            continue
+        states[filepath] = (stat.st_size, stat.st_mtime_ns)
+    return states
+
+
+def removePartialOutputs(filepaths: Tuple[Path, Path, Path, Path], before: dict) -> None:
+    '''Remove the outputs written by a conversion that was interrupted
+
+    Outputs that did not exist before are removed, as are files that were
+    being overwritten, while anything the conversion did not touch is kept.
+    '''
+    for (filepath, state) in outputStates(filepaths).items():
+        if filepath in before and (before[filepath] == state or filepath.is_dir()):
+            continue
+        logging.info('{}: removing partial output {}'.format(filepaths[0], filepath))
+        if filepath.is_dir():
+            shutil.rmtree(filepath)
+        else:
+            filepath.unlink()
+
+
+def existingOutputs(filepaths: Tuple[Path, Path, Path, Path], cache: Optional['ConversionCache'] = None) -> List[Path]:
+    '''The output files that converting this input would overwrite, unless forced to
+
+    Images that the cache knows are up to date are left alone, so only the
+    .xml is overwritten.
+    '''
+    if configData.forceOverwrite:
+        return []
+
+    if cache and cache.imagesUpToDate(filepaths):
+        outputs = filepaths[3:]
+    else:
+        outputs = composeOutputPaths(filepaths)
+    return [filepath for filepath in outputs if filepath.exists()]
+
+
+def composeOutputPaths(filepaths: Tuple[Path, Path, Path, Path]) -> List[Path]:
+    '''Every output file that converting this input may write'''
+    outputs = list(filepaths[1:])
+    if configData.tileSize:
+        outputs.append(composeTilePath(filepaths[0]))
+    if configData.thumbnailSize:
+        outputs.append(composeThumbnailPath(filepaths[0]))
+    outputs += [composeEncoderPath(encoder, filepaths[0]) for encoder in configData.encoders]
+    return outputs
+
+
+def checkFiles(jobs: List[Tuple[Path, Path, Path, Path]], portalWidthAdjustment: str, portalLengthAdjustment: str) -> int:
+    '''Check a batch of Universal VTT files for problems without converting them'''
+    exitcode = 0
+    writers = {}
+    for filepaths in jobs:
+        problems = []
+        for filepath in composeOutputPaths(filepaths):
+            # Within a module only the names of the files matter
+            key = ModuleWriter.entryName(filepath) if configData.module else filepath.resolve()
+            if key in writers:
+                problems.append('{} is also written by {}'.format(filepath, writers[key]))
+            else:
+                writers[key] = filepaths[0]
+        if not configData.module:
+            problems += ['{} already exists'.format(filepath) for filepath in existingOutputs(filepaths)]
+
+        try:
+            uvttfile = UVTTFile(filepaths[0], portalWidthAdjustment, portalLengthAdjustment, loadImage=False)
+            (counts, geometryProblems) = uvttfile.checkGeometry()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error('{}: {}, skipping'.format(filepaths[0], e))
+            exitcode = errno.EIO
+            continue
+        problems += geometryProblems
+
+        if counts:
+            print('{}: {} occluders, {} points, {} lights'.format(
+                filepaths[0], counts['occluders'], counts['points'], counts['lights']))
+        else:
+            print('{}:'.format(filepaths[0]))
+        for problem in problems:
+            print('  {}'.format(problem))
+        if problems:
+            exitcode = exitcode or errno.EINVAL
+
+    return exitcode
+
+
+def applyImageLimits() -> None:
+    '''Set the largest image that will be decoded from the configuration'''
+    if configData.maxImageFileSize is not None:
+        if configData.maxImageFileSize == 0:
+            Image.MAX_IMAGE_PIXELS = None
+        else:
+            Image.MAX_IMAGE_PIXELS = int(configData.maxImageFileSize)
+
+
+class ConversionCache(object):
+    '''Manifest of earlier conversions, used to skip files whose outputs are up to date'''
+    fileName = '.uvtt2fgu-cache.json'
+
+    def __init__(self, directory: Path, settings: dict) -> None:
+        self.path = directory / self.fileName
+        self.settings = settings
+        self.hits = 0
+        self.converted = 0
+        self.entries = {}
+        self.hashes = {}
+        self.currentImages = set()
+
+        if self.path.exists():
+            try:
+                with self.path.open('r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning('{}: unable to read cache, ignoring it: {}'.format(self.path, e))
+
+    @staticmethod
+    def fileStat(filepath: Path) -> dict:
+        '''The size and modification time of a file'''
+        stat = filepath.stat()
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    @staticmethod
+    def fileHash(filepath: Path) -> str:
+        '''The SHA-256 hash of the contents of a file'''
+        digest = hashlib.sha256()
+        with filepath.open('rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, filepaths: Tuple[Path, ...]) -> str:
+        return str(filepaths[0].resolve())
+
+    def inputHash(self, filepaths: Tuple[Path, ...]) -> str:
+        '''The hash of an input file, computed at most once per run'''
+        key = self.key(filepaths)
+        if key not in self.hashes:
+            self.hashes[key] = self.fileHash(filepaths[0])
+        return self.hashes[key]
+
+    def imageOutputs(self, filepaths: Tuple[Path, Path, Path, Path]) -> List[Path]:
+        '''The image files that a conversion with the current settings writes'''
+        (uvttpath, pngpath, jpgpath, xmlpath) = filepaths
+        outputs = []
+        if configData.writepng:
+            outputs.append(pngpath)
+        if configData.writejpg:
+            outputs.append(jpgpath)
+        if configData.tileSize:
+            outputs.append(composeTilePath(uvttpath) / 'tiles.json')
+        if configData.thumbnailSize:
+            outputs.append(composeThumbnailPath(uvttpath))
+        outputs.extend(composeEncoderPath(encoder, uvttpath) for encoder in configData.encoders)
+        return outputs
+
+    def outputsCurrent(self, entry: dict, outputs: List[Path]) -> bool:
+        '''Check that each output is unchanged since it was recorded'''
+        for output in outputs:
+            recorded = entry['outputs'].get(str(output))
+            if not recorded or not output.exists() or self.fileStat(output) != recorded:
+                return False
+        return True
+
+    def isUpToDate(self, filepaths: Tuple[Path, Path, Path, Path]) -> bool:
+        '''Check whether the outputs for this input are current, counting the hits
+
+        Afterwards imagesUpToDate() tells whether just the .xml is out of date.
+        '''
+        key = self.key(filepaths)
+        self.currentImages.discard(key)
+
+        entry = self.entries.get(key)
+        if not entry or not self.inputCurrent(filepaths, entry):
+            return False
+
+        if entry['settings'].get('image') == self.settings['image'] and \
+                self.outputsCurrent(entry, self.imageOutputs(filepaths)):
+            self.currentImages.add(key)
+
+            if entry['settings'].get('geometry') == self.settings['geometry'] and \
+                    self.outputsCurrent(entry, [filepaths[3]]):
+                self.hits += 1
+                return True
+
+        return False
+
+    def inputCurrent(self, filepaths: Tuple[Path, Path, Path, Path], entry: dict) -> bool:
+        '''Check that the input file has the same contents as when it was recorded'''
+        inputStat = self.fileStat(filepaths[0])
+        if inputStat == entry['input']:
+            return True
+        if self.inputHash(filepaths) != entry['hash']:
+            return False
+
+        # Same contents, just touched
+        entry['input'] = inputStat
+        return True
+
+    def imagesUpToDate(self, filepaths: Tuple[Path, Path, Path, Path]) -> bool:
+        '''Whether the last isUpToDate() check found this input's images to be current'''
+        return self.key(filepaths) in self.currentImages
+
+    def update(self, filepaths: Tuple[Path, Path, Path, Path], exitcode: int) -> None:
+        '''Record the result of converting a file, counting the successful conversions'''
+        key = self.key(filepaths)
+        self.currentImages.discard(key)
+        if exitcode or not filepaths[0].exists():
+            self.entries.pop(key, None)
+            return
+
+        self.converted += 1
+        outputs = self.imageOutputs(filepaths) + [filepaths[3]]
+        self.entries[key] = {
+            'input': self.fileStat(filepaths[0]),
+            'hash': self.inputHash(filepaths),
+            'settings': self.settings,
+            'outputs': {str(output): self.fileStat(output) for output in outputs},
+        }
+
+    def save(self) -> None:
+        '''Write the manifest back out'''
+        tmppath = self.path.with_name(self.path.name + '.tmp')
+        with tmppath.open('w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmppath, self.path)
+
+
+def conversionSettings(portalWidthAdjustment: str, portalLengthAdjustment: str) -> dict:
+    '''The settings that affect the content of the output files
+
+    They are split into the settings for the .xml geometry and the settings
+    for the images.
+    '''
+    return {
+        'geometry': {
+            'portalwidth': portalWidthAdjustment,
+            'portallength': portalLengthAdjustment,
+            'objectsareterrain': bool(configData.objectsAreTerrain),
+            'simplify': configData.simplify,
+            'mergewalls': configData.mergeWalls,
+        },
+        'image': {
+            'writepng': configData.writepng,
+            'writejpg': configData.writejpg,
+            'jpgquality': configData.jpgQuality,
+            'jpgsubsampling': configData.jpgSubsampling,
+            'jpgoptimize': configData.jpgOptimize,
+            'jpgmaxbytes': configData.jpgMaxBytes,
+            'tilesize': configData.tileSize,
+            'thumbnail': list(configData.thumbnailSize) if configData.thumbnailSize else None,
+            'tilelevels': configData.tileLevels,
+            'encoders': {encoder.name: encoder.settings() for encoder in configData.encoders},
+        },
+    }
+
+
 def composeFilePaths(filepath: Path) -> Tuple[Path, Path, Path, Path]:
     '''Take the input filepath and output the full set of input and output paths
 
@@ -472,6 +2599,21 @@ def composeFilePaths(filepath: Path) -> Tuple[Path, Path, Path, Path]:
     return (vttpath, pngpath, jpgpath, xmlpath)
 
 
+def composeEncoderPath(encoder: ImageEncoder, filepath: Path) -> Path:
+    '''Take the input filepath and output the path for one of the additional image encoders'''
+    return Path.joinpath(Path(encoder.path), filepath.stem + encoder.suffix)
+
+
+def composeThumbnailPath(filepath: Path) -> Path:
+    '''Take the input filepath and output the path for its thumbnail'''
+    return Path.joinpath(Path(configData.jpgpath), filepath.stem + '_thumbnail.jpg')
+
+
+def composeTilePath(filepath: Path) -> Path:
+    '''Take the input filepath and output the directory for its image tiles'''
+    return Path.joinpath(Path(configData.jpgpath), filepath.stem + '_tiles')
+
+
 class PortalAdjust(argparse.Action):
     '''Parse the command-line arguments to verify that it is either a percentage, or a pixel count'''
 
@@ -497,18 +2639,47 @@ def init_argparse() -> argparse.ArgumentParser:
         usage='%(prog)s [OPTIONS] [FILES]',
         description='Convert Dungeondraft .dd2vtt files to .jpg/.png/.xml for Fantasy Grounds Unity (FGU)'
     )
+    parser.add_argument(
+        '--cache', help='Skip files whose outputs are up to date, using a manifest in the xml output directory', action='store_true'
+    )
+    parser.add_argument(
+        '--check', '--dry-run', dest='check', action='store_true',
+        help='Check the geometry and outputs of each file for problems without converting it'
+    )
     parser.add_argument(
         '-c', '--config', help='Configuration file'
     )
     parser.add_argument(
         '-f', '--force', help='Force overwrite destination files', action='store_true'
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int, help='Number of files to convert in parallel, 0 for one per CPU'
+    )
+    parser.add_argument(
+        '--jpgmaxbytes', type=parseByteSize, help='Lower the .jpg quality as needed to fit in this size, such as 800K or 2M'
+    )
+    parser.add_argument(
+        '--jsonbackend', choices=jsonBackends, help='JSON parser to read .dd2vtt files with, auto uses orjson if it is installed'
+    )
     parser.add_argument(
         '-l', '--log', dest='logLevel', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Set the logging level'
     )
+    parser.add_argument(
+        '--maxmemory', '--max-memory', type=parseByteSize, metavar='SIZE',
+        help='Only convert files in parallel while their estimated memory use fits in this size, such as 6G'
+    )
+    parser.add_argument(
+        '--merge', dest='mergeWalls', help='Merge touching and overlapping walls into fewer occluders', action='store_true'
+    )
+    parser.add_argument(
+        '--module', metavar='FILE', help='Write the outputs into this Fantasy Grounds module archive instead of separate files'
+    )
     parser.add_argument(
         '-o', '--output', help='Path to the output directory'
     )
+    parser.add_argument(
+        '--profile', help='Print the time and memory each stage of the conversion took', action='store_true'
+    )
     parser.add_argument(
         '--portalwidth', help='Width of portals', default='25%'
     )
@@ -518,6 +2689,34 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument(
         '-r', '--remove', help='Remove the input dd2vtt file after conversion'
     )
+    parser.add_argument(
+        '--simplify', nargs=1, action=PortalAdjust, help='Remove wall points within this distance of a straight line, as ##%% of the grid or ##px'
+    )
+    parser.add_argument(
+        '--stats', metavar='FILE', help='Append the statistics of each stage of the conversion to this file as JSON lines'
+    )
+    parser.add_argument(
+        '--streaming', help='Decode the map image incrementally to reduce memory use', action='store_true'
+    )
+    parser.add_argument(
+        '--thumbnail', type=parseImageSize, metavar='WxH', help='Also write a .jpg thumbnail that fits in this size, such as 256x256'
+    )
+    parser.add_argument(
+        '--tilesize', type=int, help='Also write the image as tiles of this many pixels square'
+    )
+    parser.add_argument(
+        '--tilelevels', type=int, help='Number of half size levels of tiles to write'
+    )
+    parser.add_argument(
+        '--watch', metavar='DIR', help='Convert .dd2vtt files as they are saved into this directory, until interrupted'
+    )
+    parser.add_argument(
+        '--watchinterval', type=float, help='Seconds between checks of the --watch directory'
+    )
+    parser.add_argument(
+        '--write', dest='encoders', action='append', choices=[encoder.name for encoder in imageEncoders],
+        help='Also write the image in this format, may be given more than once'
+    )
     parser.add_argument(
         '-v', '--version', action='version', version=f'{parser.prog} version 1.5.1'
     )
@@ -560,20 +2759,86 @@ def main() -> int:
         configData.remove = args.remove
     if not configData.remove:
         configData.remove = False
+    if args.jobs is not None:
+        configData.jobs = args.jobs
+    if args.maxmemory is not None:
+        configData.maxMemory = args.maxmemory
+    if args.streaming:
+        configData.streaming = args.streaming
+    if args.jsonbackend:
+        configData.jsonBackend = args.jsonbackend
+    if args.cache:
+        configData.cache = args.cache
+    if args.simplify:
+        configData.simplify = args.simplify
+    if args.mergeWalls:
+        configData.mergeWalls = args.mergeWalls
+    if args.jpgmaxbytes is not None:
+        configData.jpgMaxBytes = args.jpgmaxbytes
+    for name in args.encoders or []:
+        configData.enableEncoder(name)
+    for encoder in configData.encoders:
+        if args.output:
+            encoder.path = args.output
+        if not encoder.path:
+            encoder.path = '.'
+    if args.profile:
+        configData.profile = args.profile
+    if args.stats:
+        configData.statsPath = args.stats
+    if args.module:
+        configData.module = args.module
+    if args.watchinterval is not None:
+        configData.watchInterval = args.watchinterval
+    if args.thumbnail:
+        configData.thumbnailSize = args.thumbnail
+    if args.tilesize is not None:
+        configData.tileSize = args.tilesize
+    if args.tilelevels is not None:
+        configData.tileLevels = args.tilelevels
 
     # Verify that the destination directories exist (if we are writing that
     # file)
-    if not Path(configData.xmlpath).exists():
+    if configData.module:
+        if configData.tileSize or configData.cache or args.watch:
+            logging.error('--module cannot be used with --tilesize, --cache or --watch')
+            return errno.EINVAL
+        if not Path(configData.module).parent.exists():
+            logging.error('{}: No such file or directory'.format(Path(configData.module).parent))
+            return errno.ENOENT
+        if Path(configData.module).exists() and not configData.forceOverwrite:
+            logging.error('{}: file already exists'.format(configData.module))
+            return errno.EEXIST
+    elif not Path(configData.xmlpath).exists():
         logging.error('{}: No such file or directory'.format(configData.xmlpath))
         return errno.ENOENT
-    if not Path(configData.pngpath).exists() and configData.writepng:
+    elif not Path(configData.pngpath).exists() and configData.writepng:
         logging.error('{}: No such file or directory'.format(configData.pngpath))
         return errno.ENOENT
-    if not Path(configData.jpgpath).exists() and configData.writejpg:
+    elif not Path(configData.jpgpath).exists() and (configData.writejpg or configData.tileSize or configData.thumbnailSize):
         logging.error('{}: No such file or directory'.format(configData.jpgpath))
         return errno.ENOENT
-
-    if not args.files:
+    for encoder in configData.encoders if not configData.module else []:
+        if not Path(encoder.path).exists():
+            logging.error('{}: No such file or directory'.format(encoder.path))
+            return errno.ENOENT
+    if configData.jsonBackend not in jsonBackends:
+        logging.error('JSON backend must be one of {}'.format(', '.join(jsonBackends)))
+        return errno.EINVAL
+    if configData.tileSize and configData.tileSize % (2 ** configData.tileLevels):
+        logging.error('Tile size {} must be divisible by {} for {} tile levels'.format(
+            configData.tileSize, 2 ** configData.tileLevels, configData.tileLevels))
+        return errno.EINVAL
+
+    if args.check and args.watch:
+        logging.error('--check cannot be used with --watch')
+        return errno.EINVAL
+
+    if args.watch:
+        if not Path(args.watch).is_dir():
+            logging.error('{}: No such directory'.format(args.watch))
+            return errno.ENOENT
+    elif not args.files:
         if not configData.alllocaldd2vttfiles:
             logging.warning('No files specified')
             return errno.EINVAL
@@ -581,12 +2846,36 @@ def main() -> int:
             cwd = Path('.')
             args.files = list(cwd.glob('*.dd2vtt'))
 
-    if configData.maxImageFileSize is not None:
-        if configData.maxImageFileSize == 0:
-            Image.MAX_IMAGE_PIXELS = None
-        else:
-            Image.MAX_IMAGE_PIXELS = int(configData.maxImageFileSize)
-
+    if args.check:
+        jobs = []
+        for filename in args.files:
+            filepaths = composeFilePaths(Path(filename))
+            if not filepaths[0].exists():
+                logging.error('{}: No such file or directory, skipping'.format(filepaths[0]))
+                exitcode = errno.ENOENT
+                continue
+            jobs.append(filepaths)
+        return checkFiles(jobs, args.portalwidth, args.portallength) or exitcode
+
+    applyImageLimits()
+
+    cache = None
+    if configData.cache:
+        cache = ConversionCache(Path(configData.xmlpath),
+                                conversionSettings(args.portalwidth, args.portallength))
+
+    stats = None
+    if configData.profile or configData.statsPath:
+        stats = ConversionStats(Path(configData.statsPath) if configData.statsPath else None)
+
+    if args.watch:
+        exitcode = watchFolder(Path(args.watch), args.portalwidth, args.portallength, cache, stats=stats)
+        if configData.profile:
+            print('\n'.join(stats.summary()))
+        return exitcode
+
+    jobs = []
+    moduleNames = set()
     for filename in args.files:
         filepaths = composeFilePaths(Path(filename))
 
@@ -597,18 +2886,42 @@ def main() -> int:
             exitcode = errno.ENOENT
             continue
 
-        if not configData.forceOverwrite:
-            for filepath in filepaths[1:]:
-                if filepath.exists():
-                    logging.error(
-                        '{}: file already exists, skipping'.format(filepath))
-                    exitcode = errno.EEXIST
-                    continue
-
-            if exitcode:
-                return exitcode
+        if cache and cache.isUpToDate(filepaths):
+            logging.info('{}: outputs are up to date, skipping'.format(filepaths[0]))
+            continue
 
-        processFile(filepaths, args.portalwidth, args.portallength)
+        if configData.module:
+            # Maps from different directories may have the same name
+            name = ModuleWriter.entryName(filepaths[3])
+            if name in moduleNames:
+                logging.error('{}: {} is already in the module, skipping'.format(filepaths[0], name))
+                exitcode = errno.EEXIST
+                continue
+            moduleNames.add(name)
+        else:
+            existing = existingOutputs(filepaths, cache)
+            for filepath in existing:
+                logging.error(
+                    '{}: file already exists, skipping'.format(filepath))
+            if existing:
+                exitcode = errno.EEXIST
+                continue
+
+        jobs.append(filepaths)
+
+    module = ModuleWriter(Path(configData.module)) if configData.module else None
+    try:
+        exitcode = processFiles(jobs, args.portalwidth, args.portallength, cache, stats, module) or exitcode
+    finally:
+        if module:
+            module.close()
+
+    if configData.profile:
+        print('\n'.join(stats.summary()))
+
+    if cache:
+        cache.save()
+        logging.info('Cache: {} up to date, {} converted'.format(cache.hits, cache.converted))
 
     return exitcode
 